@@ -0,0 +1,65 @@
+import time
+
+import psycopg2
+from decouple import config
+
+from src.db.mediator_db import PREPARED_STATEMENTS
+
+# Requests per second of a busy mediator and the URLs referenced by a typical query
+rate = 200
+duration = 10
+urls = [f"https://www.sdsc.edu/ArcGIS/rest/services/test/FeatureServer/{i}" for i in range(3)]
+
+connection = psycopg2.connect(
+    host=config('db_host'),
+    dbname=config('db_name'),
+    user=config('db_user'),
+    password=config('db_password'),
+    port=config('db_port'),
+)
+parameter_types, statement = PREPARED_STATEMENTS['md_get_invalid_urls']
+text_statement = statement.replace('$1', '%s::text[]')
+
+
+def run(cursor, query):
+    """
+    Run the query at the target rate and return the latencies in milliseconds.
+    """
+    latencies = []
+    interval = 1 / rate
+    next_time = time.perf_counter()
+    for _ in range(rate * duration):
+        start_time = time.perf_counter()
+        cursor.execute(query, (urls,))
+        cursor.fetchall()
+        connection.commit()
+        latencies.append((time.perf_counter() - start_time) * 1000)
+
+        next_time += interval
+        time.sleep(max(0.0, next_time - time.perf_counter()))
+    return sorted(latencies)
+
+
+def planning_time(cursor, query):
+    """
+    Get the planning time of the query in milliseconds as reported by EXPLAIN ANALYZE.
+    """
+    cursor.execute(f"EXPLAIN (ANALYZE, SUMMARY) {query}", (urls,))
+    rows = [row[0] for row in cursor.fetchall()]
+    connection.commit()
+    return next(float(row.split()[2]) for row in rows if row.startswith('Planning Time'))
+
+
+with connection.cursor() as cursor:
+    cursor.execute(f"PREPARE md_get_invalid_urls({parameter_types}) AS {statement};")
+    connection.commit()
+
+    for name, query in [('Unprepared', text_statement), ('Prepared', "EXECUTE md_get_invalid_urls(%s)")]:
+        latencies = run(cursor, query)
+        print('=' * 70)
+        print(f'{name} get_invalid_urls at {rate} queries per second')
+        print(f'Planning time: {planning_time(cursor, query):.3f} ms')
+        print(f'Median latency: {latencies[len(latencies) // 2]:.3f} ms')
+        print(f'99th percentile latency: {latencies[int(len(latencies) * 0.99)]:.3f} ms')
+
+connection.close()
@@ -0,0 +1,28 @@
+import timeit
+
+from src.query_parser.mediator_query import MediatorQuery
+
+# Build a large analytical query joining many URL tables
+urls = [f"https://www.sdsc.edu/ArcGIS/rest/services/test/FeatureServer/{i}" for i in range(20)]
+columns = ',\n    '.join(f'"{url}".objectid AS id_{i}, sum("{url}".shape_area) AS area_{i}'
+                         for i, url in enumerate(urls))
+joins = '\n'.join(f'JOIN "{url}" ON "{url}".objectid = "{urls[0]}".objectid' for url in urls[1:])
+group_by = ', '.join(f'"{url}".objectid' for url in urls)
+query = f'''
+    SELECT {columns}
+      FROM "{urls[0]}"
+    {joins}
+     WHERE "{urls[0]}".objectid > 100 AND "{urls[1]}".name LIKE 'San%'
+  GROUP BY {group_by}
+  ORDER BY 1
+'''
+
+number = 200
+for output_mode in ['indented', 'compact', 'splice']:
+    md_query = MediatorQuery(query, output_mode)
+    seconds = timeit.timeit(lambda: MediatorQuery(query, output_mode), number=number)
+
+    print('=' * 70)
+    print(f'Output mode: {output_mode}')
+    print(f'Average translation time: {seconds / number * 1000:.3f} ms')
+    print(f'Translated SQL length: {len(md_query.sql)} characters')
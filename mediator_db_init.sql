@@ -8,14 +8,47 @@ CREATE TABLE md_data_status(
     fetch_requested_time timestamp NOT NULL default now(),
     status_updated_time timestamp default now() NOT NULL,
     last_used_time timestamp,
-    notes TEXT
+    notes TEXT,
+    refresh_state TEXT
 );
 
+-- Every lookup of a data status is by URL, and a URL can only be loaded once
+CREATE UNIQUE INDEX IF NOT EXISTS md_data_status_url_idx ON md_data_status(url);
+
 
 CREATE VIEW md_v_data_status AS
     SELECT url, status, fetch_requested_user, fetch_requested_time, status_updated_time
       FROM md_data_status;
 
+-- The queue of data loads. A job is claimed by a data loader daemon, which renews its lease
+-- with heartbeats, so the job of a daemon that died is claimed again by another one.
+CREATE TABLE IF NOT EXISTS md_load_jobs(
+    job_id BIGSERIAL primary key,
+    url VARCHAR(256) NOT NULL,
+    table_name VARCHAR(36) NOT NULL,
+    requested_user VARCHAR(32) NOT NULL,
+    job_type VARCHAR(16) NOT NULL default 'load',
+    status VARCHAR(16) NOT NULL default 'Pending',
+    worker VARCHAR(128),
+    attempts INTEGER NOT NULL default 0,
+    enqueued_time timestamp NOT NULL default now(),
+    started_time timestamp,
+    heartbeat_time timestamp,
+    finished_time timestamp,
+    notes TEXT
+);
+
+-- A URL has at most one unfinished load job
+CREATE UNIQUE INDEX IF NOT EXISTS md_load_jobs_active_url_idx ON md_load_jobs(url) WHERE status IN ('Pending', 'Running');
+
+-- The saved chunks of the data being loaded from a URL, so a failed load resumes with the missing chunks
+CREATE TABLE IF NOT EXISTS md_load_checkpoints(
+    url VARCHAR(256) NOT NULL,
+    chunk_key VARCHAR(128) NOT NULL,
+    saved_time timestamp NOT NULL default now(),
+    PRIMARY KEY (url, chunk_key)
+);
+
 
 CREATE OR REPLACE FUNCTION md_fetch_data(url VARCHAR)
     RETURNS VOID AS $$
@@ -25,6 +58,14 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+CREATE OR REPLACE FUNCTION md_refresh_data(url VARCHAR)
+    RETURNS VOID AS $$
+BEGIN
+    RAISE EXCEPTION 'Please invoke this function using the syntax "SELECT md_refresh_data(''<URL>'')" only.';
+END;
+$$ LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION md_remove_data(input_string VARCHAR)
     RETURNS BOOLEAN AS $$
 DECLARE
@@ -49,6 +90,12 @@ BEGIN
 
     -- Step 3: Delete the corresponding entry from md_data_status
     DELETE FROM md_data_status WHERE url = input_string;
+    DELETE FROM md_load_checkpoints WHERE url = input_string;
+
+    -- Notify the status change to the data status caches of the mediator, on the channel set by
+    -- ALTER DATABASE mediator SET mediator.data_status_notify_channel = '<data_status_notify_channel>'
+    PERFORM pg_notify(COALESCE(NULLIF(current_setting('mediator.data_status_notify_channel', true), ''),
+                               'data_status'), input_string);
 
     -- Step 4: Return True
     RETURN TRUE;
@@ -0,0 +1,22 @@
+-- Add the indexes on md_data_status.url to an existing mediator database.
+-- Run it with: psql -d mediator -f migrations/001_md_data_status_url_indexes.sql
+
+BEGIN;
+
+-- Keep a single status per URL: the saved one, else the loading one, else the latest one
+DELETE FROM md_data_status
+ USING (
+    SELECT data_id,
+           row_number() OVER (PARTITION BY url
+                                  ORDER BY status = 'Saved' DESC, status = 'Loading' DESC, data_id DESC) AS position
+      FROM md_data_status
+ ) AS ranked_status
+ WHERE md_data_status.data_id = ranked_status.data_id AND ranked_status.position > 1;
+
+-- Every lookup of a data status is by URL, and a URL can only be loaded once
+CREATE UNIQUE INDEX IF NOT EXISTS md_data_status_url_idx ON md_data_status(url);
+
+-- The unique index serves the lookups of saved data too, drop the partial index added by earlier versions
+DROP INDEX IF EXISTS md_data_status_saved_url_idx;
+
+COMMIT;
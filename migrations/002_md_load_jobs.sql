@@ -0,0 +1,33 @@
+-- Add the load job queue to an existing mediator database.
+-- Run it with: psql -d mediator -f migrations/002_md_load_jobs.sql
+
+BEGIN;
+
+-- The queue of data loads. A job is claimed by a data loader daemon, which renews its lease
+-- with heartbeats, so the job of a daemon that died is claimed again by another one.
+CREATE TABLE IF NOT EXISTS md_load_jobs(
+    job_id BIGSERIAL primary key,
+    url VARCHAR(256) NOT NULL,
+    table_name VARCHAR(36) NOT NULL,
+    requested_user VARCHAR(32) NOT NULL,
+    status VARCHAR(16) NOT NULL default 'Pending',
+    worker VARCHAR(128),
+    attempts INTEGER NOT NULL default 0,
+    enqueued_time timestamp NOT NULL default now(),
+    started_time timestamp,
+    heartbeat_time timestamp,
+    finished_time timestamp,
+    notes TEXT
+);
+
+-- A URL has at most one unfinished load job
+CREATE UNIQUE INDEX IF NOT EXISTS md_load_jobs_active_url_idx ON md_load_jobs(url) WHERE status IN ('Pending', 'Running');
+
+-- Queue the loads whose notification may have been lost
+INSERT INTO md_load_jobs(url, table_name, requested_user)
+SELECT url, table_name, fetch_requested_user
+  FROM md_data_status
+ WHERE status = 'Loading'
+ON CONFLICT DO NOTHING;
+
+COMMIT;
@@ -0,0 +1,17 @@
+-- Add the load checkpoints to an existing mediator database.
+-- Run it with: psql -d mediator -f migrations/003_md_load_checkpoints.sql
+--
+-- The checkpoints of a URL whose table was dropped by md_remove_data are discarded
+-- by the next load of the URL.
+
+BEGIN;
+
+-- The saved chunks of the data being loaded from a URL, so a failed load resumes with the missing chunks
+CREATE TABLE IF NOT EXISTS md_load_checkpoints(
+    url VARCHAR(256) NOT NULL,
+    chunk_key VARCHAR(128) NOT NULL,
+    saved_time timestamp NOT NULL default now(),
+    PRIMARY KEY (url, chunk_key)
+);
+
+COMMIT;
@@ -0,0 +1,19 @@
+-- Add the incremental refresh of saved data to an existing mediator database.
+-- Run it with: psql -d mediator -f migrations/004_md_refresh_data.sql
+
+BEGIN;
+
+-- The state a data loader needs to refresh the saved data of a URL, such as the last edit date
+ALTER TABLE md_data_status ADD COLUMN IF NOT EXISTS refresh_state TEXT;
+
+-- A job either loads the data of a URL or refreshes its saved data
+ALTER TABLE md_load_jobs ADD COLUMN IF NOT EXISTS job_type VARCHAR(16) NOT NULL default 'load';
+
+CREATE OR REPLACE FUNCTION md_refresh_data(url VARCHAR)
+    RETURNS VOID AS $$
+BEGIN
+    RAISE EXCEPTION 'Please invoke this function using the syntax "SELECT md_refresh_data(''<URL>'')" only.';
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
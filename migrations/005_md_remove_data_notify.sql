@@ -0,0 +1,48 @@
+-- Let md_remove_data of an existing mediator database discard the load checkpoints of the removed URL
+-- and notify the data status caches of the mediator, like the one created by mediator_db_init.sql.
+-- Run it with: psql -d mediator -f migrations/005_md_remove_data_notify.sql
+--
+-- The return type of md_remove_data differs between the installations, so the function is replaced
+-- by dropping it first.
+
+BEGIN;
+
+DROP FUNCTION IF EXISTS md_remove_data(VARCHAR);
+
+CREATE FUNCTION md_remove_data(input_string VARCHAR)
+    RETURNS BOOLEAN AS $$
+DECLARE
+    table_to_drop VARCHAR;
+BEGIN
+    -- Step 1: Query md_data_status to get the table name
+    BEGIN
+        SELECT INTO table_to_drop table_name FROM md_data_status WHERE url = input_string;
+    EXCEPTION
+        WHEN NO_DATA_FOUND THEN
+            -- Handle the case where no data is found
+            -- RAISE EXCEPTION 'No table found for the given URL: %', input_string;
+            RETURN FALSE;
+    END;
+
+    -- Step 2: Drop the table
+    IF table_to_drop IS NOT NULL THEN
+        EXECUTE 'DROP TABLE IF EXISTS ' || table_to_drop;
+    ELSE
+        RAISE EXCEPTION 'No table found for the given URL: %', input_string;
+    END IF;
+
+    -- Step 3: Delete the corresponding entry from md_data_status
+    DELETE FROM md_data_status WHERE url = input_string;
+    DELETE FROM md_load_checkpoints WHERE url = input_string;
+
+    -- Notify the status change to the data status caches of the mediator, on the channel set by
+    -- ALTER DATABASE mediator SET mediator.data_status_notify_channel = '<data_status_notify_channel>'
+    PERFORM pg_notify(COALESCE(NULLIF(current_setting('mediator.data_status_notify_channel', true), ''),
+                               'data_status'), input_string);
+
+    -- Step 4: Return True
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
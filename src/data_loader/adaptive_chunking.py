@@ -0,0 +1,238 @@
+import concurrent
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED
+from urllib.parse import urlparse
+
+from decouple import config
+
+from src.data_loader.data_loader import DATA_LOAD_MAX_PROCESSES
+
+# Seconds a chunk should take to fetch and save. Faster chunks grow and slower chunks shrink.
+DATA_LOAD_CHUNK_TARGET_SECONDS = config('data_load_chunk_target_seconds', default=20, cast=float)
+
+# The maximum size in bytes of the response of a chunk. Larger chunks shrink.
+DATA_LOAD_CHUNK_MAX_BYTES = config('data_load_chunk_max_bytes', default=64 * 1024 * 1024, cast=int)
+
+# The bounds of the chunk sizes, as fractions of the chunk size configured for each loader
+DATA_LOAD_CHUNK_MIN_SCALE = config('data_load_chunk_min_scale', default=0.1, cast=float)
+DATA_LOAD_CHUNK_MAX_SCALE = config('data_load_chunk_max_scale', default=10.0, cast=float)
+
+# The maximum number of chunks requested from a remote server at the same time
+DATA_LOAD_MAX_IN_FLIGHT_PER_HOST = config('data_load_max_in_flight_per_host', default=DATA_LOAD_MAX_PROCESSES,
+                                          cast=int)
+
+# Seconds between two checks for free in-flight slots while the chunks of other loads use them
+IN_FLIGHT_POLL_SECONDS = 1
+
+# The weight of the latest chunk in the error rate of a host
+ERROR_RATE_WEIGHT = 0.2
+
+
+class HostController():
+    """
+    Controls the chunk size and the number of in-flight chunk requests of a remote server.
+
+    The controller follows the additive increase, multiplicative decrease (AIMD) scheme of
+    TCP congestion control, fed with the latency, payload size and retries of every chunk.
+
+    The number of in-flight requests starts at one and doubles with every round of successful
+    chunks until the first sign of congestion, then grows by one per round. A chunk which
+    needed retries or failed halves it, at most once per round, so a burst of failures of the
+    same round does not collapse it.
+
+    The chunk size is a scale of the chunk size of each loader, so loaders with different
+    chunk sizes share the controller of a server. It grows additively while chunks are fast
+    and small, and halves when a chunk is slower than DATA_LOAD_CHUNK_TARGET_SECONDS, larger
+    than DATA_LOAD_CHUNK_MAX_BYTES, or needed retries.
+
+    The controllers are shared by all the loads of a data loader daemon, but not by daemons.
+    """
+
+    def __init__(self, host, max_in_flight):
+        """
+        Initializes a HostController instance.
+
+        Args:
+            host (str): The host name of the server.
+            max_in_flight (int): The maximum number of in-flight chunk requests.
+        """
+        self.host = host
+        self.max_in_flight = max_in_flight
+        self.window = 1.0
+        self.slow_start_threshold = float(max_in_flight)
+        self.scale = 1.0
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.__completed_since_decrease = 0
+        self.__condition = threading.Condition()
+
+    def chunk_size(self, base_size, max_size=None):
+        """
+        Get the current chunk size for a loader.
+
+        Args:
+            base_size (int): The chunk size configured for the loader.
+            max_size (int): An optional limit of the server, such as the maxRecordCount of an ArcGIS layer.
+
+        Returns:
+            int: The number of features of the next chunk.
+        """
+        with self.__condition:
+            size = max(1, int(base_size * self.scale))
+        return min(size, max_size) if max_size else size
+
+    def try_acquire(self):
+        """
+        Reserve an in-flight slot if the window has a free one.
+
+        Returns:
+            bool: True if a slot is reserved, False otherwise.
+        """
+        with self.__condition:
+            if self.in_flight < int(self.window):
+                self.in_flight += 1
+                return True
+            return False
+
+    def wait_for_slot(self, timeout):
+        """
+        Wait until a slot is released by any load, or the timeout expires.
+        """
+        with self.__condition:
+            self.__condition.wait(timeout)
+
+    def release(self, seconds=None, size=None, retries=0, failed=False):
+        """
+        Release an in-flight slot and adapt the window and the chunk size to the outcome of the chunk.
+
+        Args:
+            seconds (float): The time taken by the chunk, or None if it did not run.
+            size (int): The size in bytes of the response of the chunk.
+            retries (int): The number of retries of the chunk.
+            failed (bool): True if the chunk failed after all its retries.
+        """
+        with self.__condition:
+            self.in_flight -= 1
+            self.__condition.notify_all()
+            if seconds is None and not failed:
+                return
+
+            congested = failed or retries > 0
+            self.error_rate += ERROR_RATE_WEIGHT * ((1.0 if congested else 0.0) - self.error_rate)
+            self.__completed_since_decrease += 1
+
+            if congested:
+                # Decrease once per round of in-flight chunks
+                if self.__completed_since_decrease >= self.window:
+                    self.window = max(1.0, self.window / 2)
+                    self.slow_start_threshold = self.window
+                    self.scale = max(DATA_LOAD_CHUNK_MIN_SCALE, self.scale / 2)
+                    self.__completed_since_decrease = 0
+                    logging.info(f"Backing off {self.host}: window {self.window:.1f}, chunk scale {self.scale:.2f}, "
+                                 f"error rate {self.error_rate:.2f}")
+                return
+
+            # Grow the window exponentially below the threshold and by one per round above it
+            if self.window < self.slow_start_threshold:
+                self.window += 1.0
+            else:
+                self.window += 1.0 / self.window
+            self.window = min(self.window, float(self.max_in_flight))
+
+            if seconds > DATA_LOAD_CHUNK_TARGET_SECONDS or (size or 0) > DATA_LOAD_CHUNK_MAX_BYTES:
+                self.scale = max(DATA_LOAD_CHUNK_MIN_SCALE, self.scale / 2)
+            elif seconds < DATA_LOAD_CHUNK_TARGET_SECONDS / 2 and (size or 0) < DATA_LOAD_CHUNK_MAX_BYTES / 2:
+                self.scale = min(DATA_LOAD_CHUNK_MAX_SCALE, self.scale + 0.25)
+
+
+# The controllers of the remote servers
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_host_controller(url):
+    """
+    Get the controller of the server at a URL, creating it on first use.
+
+    Args:
+        url (str): The URL of the data.
+
+    Returns:
+        HostController: The controller shared by all the loads from the server.
+    """
+    host = urlparse(url).netloc.lower()
+    with _controllers_lock:
+        if host not in _controllers:
+            _controllers[host] = HostController(host, DATA_LOAD_MAX_IN_FLIGHT_PER_HOST)
+        return _controllers[host]
+
+
+def run_chunks(executor, controller, next_chunk, serial_first=False):
+    """
+    Submit chunks to a process pool as fast as the controller of their server allows and wait for them.
+
+    Every chunk function returns a dict with the 'seconds', 'bytes' and 'retries' of the chunk,
+    which the controller adapts to.
+
+    Args:
+        executor (ProcessPoolExecutor): The process pool.
+        controller (HostController): The controller of the server.
+        next_chunk (callable): Called with no arguments when a slot is free. Returns the chunk key,
+                               function and arguments of the next chunk, or None if no chunk remains.
+                               It may raise to stop the load, such as when the load is cancelled.
+        serial_first (bool): True to complete the first chunk before submitting the others,
+                             for example to let it create the table.
+
+    Returns:
+        dict: The result of every chunk by its chunk key.
+
+    Raises:
+        Exception: The error of the first failed chunk or of next_chunk, once the other chunks are
+                   cancelled or completed.
+    """
+    def cancel_pending():
+        # Cancel the chunks of this load only, the pool may be shared with other loads
+        for pending_future in pending:
+            pending_future.cancel()
+        concurrent.futures.wait(pending)
+        for _ in pending:
+            controller.release()
+
+    pending = {}
+    results = {}
+    exhausted = False
+    while True:
+        # Submit chunks while the window has free slots
+        while not exhausted and not (serial_first and pending and not results) and controller.try_acquire():
+            try:
+                chunk = next_chunk()
+            except BaseException:
+                controller.release()
+                cancel_pending()
+                raise
+            if chunk is None:
+                controller.release()
+                exhausted = True
+                break
+            chunk_key, function, args = chunk
+            pending[executor.submit(function, *args)] = chunk_key
+
+        if not pending:
+            if exhausted:
+                return results
+            # The chunks of other loads from the same server use all the slots
+            controller.wait_for_slot(IN_FLIGHT_POLL_SECONDS)
+            continue
+
+        done, _ = concurrent.futures.wait(pending, timeout=IN_FLIGHT_POLL_SECONDS, return_when=FIRST_COMPLETED)
+        for future in done:
+            chunk_key = pending.pop(future)
+            if future.exception() is not None:
+                controller.release(failed=True)
+                cancel_pending()
+                raise future.exception()
+
+            result = future.result()
+            controller.release(seconds=result['seconds'], size=result['bytes'], retries=result['retries'])
+            results[chunk_key] = result
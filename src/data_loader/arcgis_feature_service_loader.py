@@ -1,22 +1,77 @@
-import concurrent
+import bisect
 import logging
 import time
 from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 
-import geopandas
-import numpy
 import requests
 from arcgis.auth.api import urllib3
 from arcgis.features import FeatureLayer
 from decouple import config
-from sqlalchemy import create_engine, NullPool
 
-from src.data_loader.data_loader import DataLoader, DataLoaderError
+from src.data_loader.adaptive_chunking import get_host_controller, run_chunks
+from src.data_loader.data_loader import DataLoader, DataLoaderError, LoadCancelledError, DATA_LOAD_MAX_PROCESSES
+from src.data_loader.esri_pbf import decode_features
+from src.data_loader.geojson_stream import READ_SIZE, iter_batches, iter_features
+from src.data_loader.postgis_writer import DATA_LOAD_WRITE_BATCH_SIZE, arcgis_columns, geojson_to_records, \
+    write_batches, write_features
 
 DATA_LOAD_RETRIES_ON_ERROR = config('data_load_retries_on_error', cast=int)
 
 
-def load_features(self_url, table_name, where, wkid, schema):
+def query_features(self_url, params, query_format):
+    """
+    Query the features of a layer in the given output format.
+
+    PBF responses carry quantized, delta encoded geometries which are decoded straight into
+    arrays, and are much smaller and faster to parse than GeoJSON on dense polygon layers.
+    If a PBF response cannot be decoded, the query is made again in GeoJSON.
+
+    GeoJSON responses are streamed and parsed incrementally in batches of DATA_LOAD_WRITE_BATCH_SIZE
+    features as the batches are consumed, so the memory used does not grow with the size of the response.
+
+    Args:
+        self_url (str): The URL of the layer.
+        params (dict): The parameters of the query, without the output format.
+        query_format (str): 'pbf' or 'geojson'.
+
+    Returns:
+        tuple: The batches of the attributes of the features as dicts and their shapely geometries, and
+               the response, which must be closed once the batches are consumed.
+    """
+    if query_format == 'pbf':
+        resp = requests.post(self_url + "/query", data={**params, 'f': 'pbf'}, verify=False)
+        resp.raise_for_status()
+        try:
+            return [decode_features(resp.content)], resp
+        except Exception as e:
+            logging.info(f"Falling back to GeoJSON, failed decoding the PBF response: {self_url}: {e}")
+
+    resp = requests.post(self_url + "/query", data={**params, 'f': 'geojson'}, verify=False, stream=True)
+    resp.raise_for_status()
+    features = iter_features(resp.iter_content(chunk_size=READ_SIZE))
+    return (geojson_to_records(batch) for batch in iter_batches(features, DATA_LOAD_WRITE_BATCH_SIZE)), resp
+
+
+def get_query_format(layer):
+    """
+    Get the preferred output format of the queries of a layer, which is PBF if the layer supports it.
+
+    Returns:
+        str: 'pbf' or 'geojson'.
+    """
+    supported_formats = layer.properties.get('supportedQueryFormats') or ''
+    formats = [query_format.strip().lower() for query_format in supported_formats.split(',')]
+    return 'pbf' if 'pbf' in formats else 'geojson'
+
+
+def load_features(self_url, table_name, where, wkid, schema, chunk_key, query_format='geojson'):
+    """
+    Load the features matching a where clause and record the checkpoint of their chunk.
+
+    Returns:
+        dict: The seconds, response bytes and retries of the successful attempt.
+    """
     logging.info(f"Loading by query: {where}: {self_url}")
 
     # Set the number of retries in case of an error during loading
@@ -27,49 +82,83 @@ def load_features(self_url, table_name, where, wkid, schema):
 
     # Retry loading features in case of an error or no error
     while tries < DATA_LOAD_RETRIES_ON_ERROR:
+        start_time = time.monotonic()
         try:
-            url_string = self_url + "/query?where={}&returnGeometry=true&outFields={}&f=geojson".format(where, '*')
-            resp = requests.get(url_string, verify=False)
-            data = resp.json()
-
-            gdf = geopandas.GeoDataFrame.from_features(data['features'], crs=f'EPSG:{wkid}')
-            gdf = gdf.loc[gdf['geometry'].is_valid, :]
-
-            gdf.replace([numpy.nan, numpy.inf, -numpy.inf], 0, inplace=True)
-            for field in schema:
-                if field['type'] == 'esriFieldTypeInteger':
-                    gdf[field['name']] = gdf[field['name']].astype('int64')
-                elif field['type'] == 'esriFieldTypeSmallInteger':
-                    gdf[field['name']] = gdf[field['name']].astype('int64')
-                elif field['type'] == 'esriFieldTypeString':
-                    gdf[field['name']] = gdf[field['name']].astype('str')
+            batches, resp = query_features(self_url, {
+                'where': where,
+                'returnGeometry': 'true',
+                'outFields': '*',
+                'outSR': wkid
+            }, query_format)
 
-            # Construct the PostgreSQL connection URL
-            postgres_url = f"postgresql://{config('db_user')}:{config('db_password')}@{config('db_host')}:{config('db_port')}/{config('db_name')}"
-
-            # Create the SQLAlchemy engine
-            engine = create_engine(postgres_url, poolclass=NullPool)
-
-            # Use the connection for GeoDataFrame.to_postgis
-            gdf.to_postgis(name=table_name, con=engine, schema='public', if_exists='append')
-
-            # Explicitly close the engine
-            engine.dispose()
+            # Stream the features and their checkpoint into the table in a single transaction
+            with resp:
+                write_batches(table_name, arcgis_columns(schema), wkid, batches, url=self_url, chunk_key=chunk_key)
 
             # Log the successful loading of features
             logging.info(f"Done the query: {where}: {self_url}")
-            return where
+            return {'seconds': time.monotonic() - start_time, 'bytes': resp.raw.tell(), 'retries': tries}
         except Exception as e:
             # Log the retry attempt in case of an error
             logging.info(f"Try loading by query again: {where}: {self_url}: {tries}: {e}")
             tries += 1
 
-    # If all retries fail, set the error event and raise an exception
+    # If all retries fail, raise an exception, the load sets the error once its other chunks are done
     logging.info(f"Failed loading by query: {where}: {self_url}")
-    DataLoader.set_loading_error(self_url, f"Failed loading by query: {where}")
     raise DataLoaderError(f"Failed loading by query: {where}: {self_url}")
 
 
+def refresh_features(self_url, table_name, object_ids, id_field_name, wkid, schema, query_format='geojson'):
+    """
+    Replace the saved features with the given objectIds by their current version.
+    Features which no longer exist or whose geometry is invalid are deleted.
+
+    Args:
+        self_url (str): The URL of the layer.
+        table_name (str): The name of the table of the saved features.
+        object_ids (list): The objectIds of the features, at most maxRecordCount of them.
+        id_field_name (str): The name of the objectId field.
+        wkid (int): The spatial reference of the layer.
+        schema (list): The fields of the layer.
+        query_format (str): 'pbf' or 'geojson'.
+
+    Returns:
+        dict: The seconds, response bytes and retries of the successful attempt.
+    """
+    chunk = f"{len(object_ids)} objectIds from {object_ids[0]} to {object_ids[-1]}"
+    logging.info(f"Refreshing {chunk}: {self_url}")
+
+    # Set the number of retries in case of an error during refreshing
+    tries = 0
+
+    # Disable SSL warnings for this request
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    while tries < DATA_LOAD_RETRIES_ON_ERROR:
+        start_time = time.monotonic()
+        try:
+            # POST the objectIds, which may not fit in a URL
+            batches, resp = query_features(self_url, {
+                'objectIds': ','.join(str(object_id) for object_id in object_ids),
+                'returnGeometry': 'true',
+                'outFields': '*',
+                'outSR': wkid
+            }, query_format)
+
+            # Replace the saved features by their current version in a single transaction
+            with resp:
+                write_batches(table_name, arcgis_columns(schema), wkid, batches, key_column=id_field_name,
+                              keys=object_ids)
+
+            logging.info(f"Done refreshing {chunk}: {self_url}")
+            return {'seconds': time.monotonic() - start_time, 'bytes': resp.raw.tell(), 'retries': tries}
+        except Exception as e:
+            logging.info(f"Try refreshing again: {chunk}: {self_url}: {tries}: {e}")
+            tries += 1
+
+    logging.info(f"Failed refreshing {chunk}: {self_url}")
+    raise DataLoaderError(f"Failed refreshing {chunk}: {self_url}")
+
 class ArcGISFeatureServiceLoader(DataLoader):
 
     @staticmethod
@@ -107,6 +196,9 @@ class ArcGISFeatureServiceLoader(DataLoader):
 
         This method loads data into the specified table and then updates the status
         of the data associated with the URL to 'Saved' in the mediator's data status table.
+
+        Raises:
+            DataLoaderError: If a chunk fails, after the data status is set to 'Error'.
         """
         # Create a FeatureLayer by fetching its metadata
         layer = FeatureLayer(self.url)
@@ -130,6 +222,16 @@ class ArcGISFeatureServiceLoader(DataLoader):
         for field in schema:
             logging.info(f"Field Name: {field['name']}, Type: {field['type']}")
 
+        # Prefer the compact PBF output format
+        query_format = get_query_format(layer)
+        logging.info(f"Query format: {query_format}")
+
+        # Record the last edit date before reading the features, so a refresh fetches the later edits.
+        # A resumed load keeps the date recorded by its first attempt.
+        last_edit_date = self.__get_last_edit_date(layer)
+        if last_edit_date is not None and not DataLoader.get_refresh_state(self.url):
+            DataLoader.save_refresh_state(self.url, {'last_edit_date': last_edit_date})
+
         # Get objectIds of all the features
         result = layer.query(where="1=1", return_ids_only=True)
         id_field_name = result["objectIdFieldName"]
@@ -138,8 +240,10 @@ class ArcGISFeatureServiceLoader(DataLoader):
         total_record_count = len(object_ids)
         logging.info(f"Loaded {total_record_count} objectIds")
 
-        # create a process pool with the default number of worker processes
-        executor = ProcessPoolExecutor()
+        # Use the process pool shared by all the loads or create one for this load
+        executor = self.executor
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=DATA_LOAD_MAX_PROCESSES)
 
         # Check the pool size
         current_pool_size = executor._max_workers
@@ -148,39 +252,186 @@ class ArcGISFeatureServiceLoader(DataLoader):
         available_slots = executor._max_workers - len(executor._processes)
         logging.info(f"available_slots: {available_slots}")
 
-        futures = []
-        for i in range(0, total_record_count, max_record_count):
-
-            # Set up a where condition for this iteration
-            to_rec = i + (max_record_count - 1)
-            if to_rec > total_record_count:
-                to_rec = total_record_count - 1
-            from_id = object_ids[i]
-            to_id = object_ids[to_rec]
+        # Get the chunks saved by a previous load of this URL, which are not loaded again
+        checkpoints = DataLoader.get_checkpoints(self.url)
+        if checkpoints:
+            logging.info(f"Resuming the load with {len(checkpoints)} chunks saved: {self.url}")
+
+        # The objectIds outside of the saved chunks, in runs not interrupted by a saved chunk
+        runs = self.__get_unsaved_runs(object_ids, id_field_name, checkpoints)
+
+        # The chunk size, at most maxRecordCount, and the number of chunks in flight adapt to the server
+        controller = get_host_controller(self.url)
+
+        run_index = 0
+        position = 0
+
+        def next_chunk():
+            nonlocal run_index, position
+            self.check_cancelled()
+            if run_index < len(runs) and position >= len(runs[run_index]):
+                run_index += 1
+                position = 0
+            if run_index >= len(runs):
+                return None
+
+            # Set up a where condition for the next chunk of the current run
+            count = controller.chunk_size(max_record_count, max_size=max_record_count)
+            chunk_ids = runs[run_index][position:position + count]
+            position += count
+            from_id = chunk_ids[0]
+            to_id = chunk_ids[-1]
             where = "{} >= {} and {} <= {}".format(id_field_name, from_id, id_field_name, to_id)
 
-            available_slots = executor._max_workers - len(executor._processes)
-            logging.info(f"--- Processing: {where}: available_slots: {available_slots} ---")
-
+            # The chunk is identified by its objectId range
+            chunk_key = f"{id_field_name}:{from_id}-{to_id}"
             logging.info(f"Submitting: {where}")
-            future = executor.submit(load_features, self.url, self.table_name, where, wkid, schema)
-            futures.append(future)
+            return chunk_key, load_features, (self.url, self.table_name, where, wkid, schema, chunk_key, query_format)
 
-            if i == 0:
-                time.sleep(5)
-
-        # Wait for all tasks to complete
-        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.ALL_COMPLETED)
-        for future in done:
-            # Process errors
-            if future.exception():
+        try:
+            run_chunks(executor, controller, next_chunk)
+        except LoadCancelledError:
+            # The data may be loaded by another worker now
+            raise
+        except Exception as e:
+            DataLoader.set_loading_error(self.url, f'Failed downloading data: {e}')
+            logging.info(f'Failed fetching data: {e}')
+            raise DataLoaderError(f'Failed downloading data: {e}') from e
+        finally:
+            if executor is not self.executor:
                 executor.shutdown()
-                concurrent.futures.wait(futures, return_when=concurrent.futures.ALL_COMPLETED)
-                DataLoader.set_loading_error(self.url, f'Failed downloading data: {future.exception()}')
-                logging.info(f'Failed fetching data: {future.exception()}')
-                return
 
         logging.info(f"Completed data loading: {self.url}")
 
         # Update the status
         DataLoader.update_data_status(self.url, 'Saved')
+
+    @staticmethod
+    def __get_unsaved_runs(object_ids, id_field_name, checkpoints):
+        """
+        Get the objectIds which are not in a saved chunk, split where a saved chunk interrupts them,
+        so the objectId range of a new chunk never overlaps a saved chunk.
+
+        Args:
+            object_ids (list): The sorted objectIds of the layer.
+            id_field_name (str): The name of the objectId field.
+            checkpoints (set): The keys of the saved chunks.
+
+        Returns:
+            list: The runs of consecutive unsaved objectIds.
+        """
+        saved_ranges = []
+        for chunk_key in checkpoints:
+            field_name, _, id_range = chunk_key.partition(':')
+            if field_name == id_field_name:
+                from_id, to_id = id_range.split('-')
+                saved_ranges.append((int(from_id), int(to_id)))
+        saved_ranges.sort()
+        starts = [from_id for from_id, _ in saved_ranges]
+
+        runs = [[]]
+        for object_id in object_ids:
+            i = bisect.bisect_right(starts, object_id) - 1
+            if i >= 0 and object_id <= saved_ranges[i][1]:
+                if runs[-1]:
+                    runs.append([])
+            else:
+                runs[-1].append(object_id)
+        return [run for run in runs if run]
+
+    @staticmethod
+    def __get_last_edit_date(layer):
+        """
+        Get the last edit date of a layer in milliseconds since the epoch.
+
+        Returns:
+            int or None: The last edit date, or None if the layer does not report it.
+        """
+        editing_info = layer.properties.get('editingInfo') or {}
+        return editing_info.get('lastEditDate')
+
+    def refresh(self):
+        """
+        Refresh the saved features with the edits of the layer since the last load or refresh.
+
+        The objectIds of the layer are compared with the saved ones to find the added and deleted
+        features, and the updated features are found with the edit date field of the layer. Only
+        these features are fetched and upserted. Without an edit date field, all the features are
+        fetched again and upserted.
+
+        Raises:
+            DataLoaderError: If the layer does not report its last edit date.
+        """
+        layer = FeatureLayer(self.url)
+
+        # Check if the layer is edited since the last load or refresh
+        last_edit_date = self.__get_last_edit_date(layer)
+        if last_edit_date is None:
+            raise DataLoaderError(f"The layer does not report its last edit date and cannot be refreshed: {self.url}")
+
+        state = DataLoader.get_refresh_state(self.url)
+        if state.get('last_edit_date') == last_edit_date:
+            logging.info(f"No edits since the last refresh: {self.url}")
+            return
+
+        wkid = layer.properties.extent.spatialReference.wkid
+        max_record_count = layer.properties.maxRecordCount
+        schema = layer.properties.fields
+        query_format = get_query_format(layer)
+
+        # Compare the objectIds of the layer with the saved ones
+        result = layer.query(where="1=1", return_ids_only=True)
+        id_field_name = result["objectIdFieldName"]
+        current_ids = set(result["objectIds"] or [])
+        saved_ids = DataLoader.get_saved_keys(self.table_name, id_field_name)
+        deleted_ids = saved_ids - current_ids
+        changed_ids = current_ids - saved_ids
+
+        # Find the features updated since the last edit date seen
+        edit_fields_info = layer.properties.get('editFieldsInfo') or {}
+        edit_date_field = edit_fields_info.get('editDateField')
+        if edit_date_field and 'last_edit_date' in state:
+            since = datetime.fromtimestamp(state['last_edit_date'] / 1000, tz=timezone.utc)
+            result = layer.query(where=f"{edit_date_field} >= timestamp '{since.strftime('%Y-%m-%d %H:%M:%S')}'",
+                                 return_ids_only=True)
+            changed_ids.update(result["objectIds"] or [])
+        else:
+            logging.info(f"No edit date field, refreshing all the features: {self.url}")
+            changed_ids = current_ids
+
+        logging.info(f"Refreshing {len(changed_ids)} changed and {len(deleted_ids)} deleted features: {self.url}")
+        if deleted_ids:
+            write_features(self.table_name, arcgis_columns(schema), wkid, [], key_column=id_field_name,
+                           keys=deleted_ids)
+
+        # Use the process pool shared by all the loads or create one for this refresh
+        executor = self.executor
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=DATA_LOAD_MAX_PROCESSES)
+
+        changed_ids = sorted(changed_ids)
+        controller = get_host_controller(self.url)
+        next_index = 0
+
+        def next_chunk():
+            nonlocal next_index
+            self.check_cancelled()
+            if next_index >= len(changed_ids):
+                return None
+            count = controller.chunk_size(max_record_count, max_size=max_record_count)
+            chunk_ids = changed_ids[next_index:next_index + count]
+            next_index += count
+            return f"{chunk_ids[0]}-{chunk_ids[-1]}", refresh_features, (self.url, self.table_name, chunk_ids,
+                                                                         id_field_name, wkid, schema, query_format)
+
+        try:
+            run_chunks(executor, controller, next_chunk)
+        except Exception as e:
+            raise DataLoaderError(f'Failed refreshing data: {e}')
+        finally:
+            if executor is not self.executor:
+                executor.shutdown()
+
+        # The next refresh fetches the edits after this one
+        DataLoader.save_refresh_state(self.url, {'last_edit_date': last_edit_date})
+        logging.info(f"Completed data refreshing: {self.url}")
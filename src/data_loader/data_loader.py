@@ -1,11 +1,24 @@
+import json
 import logging
+import threading
 from abc import ABC, abstractmethod
 
 import psycopg2
 from decouple import config
+from psycopg2 import sql
 
 from src.query_parser.url_replacement_visitor import to_table_name
 
+# The channel on which data status changes are notified
+DATA_STATUS_NOTIFY_CHANNEL = config('data_status_notify_channel', default='data_status')
+
+# The maximum number of processes loading chunks of data
+DATA_LOAD_MAX_PROCESSES = config('data_load_max_processes', cast=int)
+
+# Records a saved chunk of the data at a URL. Loaders run it in the transaction saving the chunk.
+SAVE_CHECKPOINT_SQL = "INSERT INTO md_load_checkpoints(url, chunk_key) VALUES (%(url)s, %(chunk_key)s) " \
+                      "ON CONFLICT DO NOTHING;"
+
 
 class DataLoader(ABC):
     def __init__(self, url, table_name, username):
@@ -21,6 +34,26 @@ class DataLoader(ABC):
         self.table_name = table_name
         self.username = username
 
+        # The process pool shared by all the loads of the data loader daemon. Loaders which
+        # process the data in chunks create their own pool when it is not set.
+        self.executor = None
+        # The number of worker processes of the pool
+        self.max_processes = DATA_LOAD_MAX_PROCESSES
+        # Set when the load must stop, such as when its job was leased to another worker
+        self.cancelled = threading.Event()
+
+    def check_cancelled(self):
+        """
+        Stop the load before it saves more chunks if it was cancelled.
+
+        Loaders call it before submitting every chunk. The chunks being saved are completed.
+
+        Raises:
+            LoadCancelledError: If the load was cancelled.
+        """
+        if self.cancelled.is_set():
+            raise LoadCancelledError(f"The load was cancelled: {self.url}")
+
     @staticmethod
     @abstractmethod
     def get_name() -> str:
@@ -69,6 +102,71 @@ class DataLoader(ABC):
          """
         pass
 
+    def refresh(self):
+        """
+         Refreshes the saved data in the table self.table_name with the changes at self.url.
+
+         Only the changed features are fetched and upserted. The data stays queryable while it
+         is refreshed, and its status stays 'Saved'. Loaders which cannot detect the changes of
+         their data do not support refreshing.
+
+         Raises:
+             DataLoaderError: If the data cannot be refreshed.
+         """
+        raise DataLoaderError(f"{self.get_name()} does not support refreshing data.")
+
+    @staticmethod
+    def get_refresh_state(url):
+        """
+            Get the state saved for refreshing the data at a URL.
+
+            Args:
+                url (str): The URL of the saved data.
+
+            Returns:
+                dict: The refresh state, which is empty if none is saved.
+        """
+        with psycopg2.connect(host=f"{config('db_host')}", dbname=f"{config('db_name')}",
+                              user=f"{config('db_user')}", password=f"{config('db_password')}") as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT refresh_state FROM md_data_status WHERE url = %s;", (url,))
+                row = cursor.fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    @staticmethod
+    def save_refresh_state(url, state):
+        """
+            Save the state for refreshing the data at a URL.
+
+            Args:
+                url (str): The URL of the data.
+                state (dict): The refresh state, which must be serializable to JSON.
+        """
+        with psycopg2.connect(host=f"{config('db_host')}", dbname=f"{config('db_name')}",
+                              user=f"{config('db_user')}", password=f"{config('db_password')}") as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE md_data_status SET refresh_state = %s WHERE url = %s;", (json.dumps(state), url))
+                conn.commit()
+
+    @staticmethod
+    def get_saved_keys(table_name, key_column):
+        """
+            Get the keys of all the features saved in a table.
+
+            Args:
+                table_name (str): The name of the table.
+                key_column (str): The name of the column identifying the features.
+
+            Returns:
+                set: The keys of the saved features.
+        """
+        with psycopg2.connect(host=f"{config('db_host')}", dbname=f"{config('db_name')}",
+                              user=f"{config('db_user')}", password=f"{config('db_password')}") as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("SELECT {} FROM {};").format(sql.Identifier(key_column),
+                                                                  sql.Identifier(table_name)))
+                return {row[0] for row in cursor.fetchall()}
+
     @staticmethod
     def set_loading_error(url, error_message):
         """
@@ -76,6 +174,14 @@ class DataLoader(ABC):
             It is not safe to share a connection pool with multiple processes.
             This method opens and uses a new connection in the process
 
+            The table of the URL is kept if some of its chunks are saved, so the next load of
+            the URL only loads the missing chunks. Otherwise the table is dropped together with
+            the checkpoints, in the same transaction.
+
+            Only the process running the load calls it, once no chunk of the load is being saved
+            anymore, so no checkpoint is committed between the check and the drop. Worker processes
+            raise their errors instead.
+
             Args:
                 error_message (str): The error message.
 
@@ -95,16 +201,30 @@ class DataLoader(ABC):
                 # Execute the SQL statement
                 cursor.execute(update_sql, (error_message, url))
 
-                # Drop the associated table if exists
-                delete_sql = f"DROP TABLE IF EXISTS {to_table_name(url)}"
-                logging.info(f"Execute {delete_sql} ")
-                cursor.execute(delete_sql)
+                # Notify the status change, which is sent when the transaction is committed
+                cursor.execute("SELECT pg_notify(%s, %s);", (DATA_STATUS_NOTIFY_CHANNEL, url))
+
+                # Drop the associated table if exists and no chunk of it is saved
+                cursor.execute("SELECT 1 FROM md_load_checkpoints WHERE url = %s LIMIT 1;", (url,))
+                if cursor.fetchone() is None:
+                    delete_sql = f"DROP TABLE IF EXISTS {to_table_name(url)}"
+                    logging.info(f"Execute {delete_sql} ")
+                    cursor.execute(delete_sql)
+                    cursor.execute("DELETE FROM md_load_checkpoints WHERE url = %s;", (url,))
+                else:
+                    logging.info(f"Keep the saved chunks of {url} for resuming the load")
 
                 # Commit the transaction
                 conn.commit()
 
     @staticmethod
     def drop_table(url):
+        """
+            Drop the table of a URL together with the checkpoints of its saved chunks.
+
+            Args:
+                url (str): The URL whose table is dropped.
+        """
         with psycopg2.connect(host=f"{config('db_host')}", dbname=f"{config('db_name')}",
                               user=f"{config('db_user')}", password=f"{config('db_password')}") as conn:
             with conn.cursor() as cursor:
@@ -112,10 +232,51 @@ class DataLoader(ABC):
                 delete_sql = f"DROP TABLE IF EXISTS {to_table_name(url)}"
                 logging.info(f"Execute {delete_sql} ")
                 cursor.execute(delete_sql)
+                cursor.execute("DELETE FROM md_load_checkpoints WHERE url = %s;", (url,))
 
                 # Commit the transaction
                 conn.commit()
 
+    @staticmethod
+    def get_checkpoints(url):
+        """
+            Get the keys of the saved chunks of the data at a URL.
+            Checkpoints left without the table, which was dropped in the meantime, are discarded.
+
+            Args:
+                url (str): The URL of the data being loaded.
+
+            Returns:
+                set: The keys of the saved chunks.
+        """
+        with psycopg2.connect(host=f"{config('db_host')}", dbname=f"{config('db_name')}",
+                              user=f"{config('db_user')}", password=f"{config('db_password')}") as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (to_table_name(url),))
+                if not cursor.fetchone()[0]:
+                    cursor.execute("DELETE FROM md_load_checkpoints WHERE url = %s;", (url,))
+                    conn.commit()
+                    return set()
+
+                cursor.execute("SELECT chunk_key FROM md_load_checkpoints WHERE url = %s;", (url,))
+                return {row[0] for row in cursor.fetchall()}
+
+    @staticmethod
+    def save_checkpoint(url, chunk_key):
+        """
+            Record that a chunk of the data at a URL is saved.
+            Prefer running SAVE_CHECKPOINT_SQL in the transaction saving the chunk when possible.
+
+            Args:
+                url (str): The URL of the data being loaded.
+                chunk_key (str): The key of the saved chunk.
+        """
+        with psycopg2.connect(host=f"{config('db_host')}", dbname=f"{config('db_name')}",
+                              user=f"{config('db_user')}", password=f"{config('db_password')}") as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(SAVE_CHECKPOINT_SQL, {'url': url, 'chunk_key': chunk_key})
+                conn.commit()
+
     @staticmethod
     def update_data_status(url, status):
         """
@@ -138,6 +299,13 @@ class DataLoader(ABC):
                 # Execute the SQL statement
                 cursor.execute(update_sql, (status, url))
 
+                # Notify the status change, which is sent when the transaction is committed
+                cursor.execute("SELECT pg_notify(%s, %s);", (DATA_STATUS_NOTIFY_CHANNEL, url))
+
+                # The checkpoints of saved data are no longer needed
+                if status == 'Saved':
+                    cursor.execute("DELETE FROM md_load_checkpoints WHERE url = %s;", (url,))
+
                 # Commit the transaction
                 conn.commit()
 
@@ -147,3 +315,10 @@ class DataLoaderError(Exception):
         Custom exception class for DataLoader-related errors.
     """
     pass
+
+
+class LoadCancelledError(DataLoaderError):
+    """
+        Raised by a cancelled load, whose data may be loaded by another worker and must be left as it is.
+    """
+    pass
@@ -4,7 +4,6 @@
 # but pgBouncer does not pass the value of the environment variable PYTHONPATH to Cython.
 # So this code is needed to set the location of the Python code.
 import sys
-from multiprocessing import Process
 
 from decouple import config, UndefinedValueError
 
@@ -16,16 +15,22 @@ except UndefinedValueError:
 # ------------------------------------------------------------------------------
 
 import asyncio
-import json
 import logging
+import os
+import socket
 
 import psycopg2
 
 # Configure logging
 from decouple import config
 
-from src.data_loader.data_loader import DataLoader
-from src.data_loader.data_loader_factory import DataLoaderFactory
+from src.data_loader.data_loader import DATA_LOAD_MAX_PROCESSES
+from src.data_loader.load_job_queue import LoadJobQueue, DATA_LOAD_JOB_LEASE
+from src.data_loader.load_scheduler import LoadScheduler, DATA_LOAD_MAX_CONCURRENT_LOADS
+
+# Seconds between two checks of the load job queue without any notification, which picks up
+# the jobs whose notification was missed and the jobs whose lease has expired
+DATA_LOAD_JOB_POLL_INTERVAL = config('data_load_job_poll_interval', default=30, cast=int)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -34,25 +39,14 @@ logging.basicConfig(
 )
 
 
-def load_data(url, username, table_name):
-    try:
-        # Start a new process to load data
-        data_loader = DataLoaderFactory.create_loader(url, table_name, username)
-
-        # If a data loader is found, proceed with loading data
-        if data_loader:
-            data_loader.load()
-        else:
-            logging.error(f"No data loader was found.: {url}")
-            DataLoader.set_loading_error(url, f"No data loader was found.")
-    except Exception as e:
-        # traceback.print_exc()
-        logging.error(f"Encountered an error when loading {url}: {str(e)}.")
-        DataLoader.set_loading_error(url, f'Encountered an error: {str(e)}.')
-        DataLoader.drop_table(url)
-
-
 async def handle_notifications():
+    loop = asyncio.get_running_loop()
+    notifications = asyncio.Queue()
+    job_queue = LoadJobQueue(f"{socket.gethostname()}:{os.getpid()}", DATA_LOAD_JOB_LEASE)
+
+    # Wake up the loop when a load is done, so the freed slot is used for the next job
+    scheduler = LoadScheduler(DATA_LOAD_MAX_CONCURRENT_LOADS, DATA_LOAD_MAX_PROCESSES, job_queue,
+                              on_load_done=lambda: loop.call_soon_threadsafe(notifications.put_nowait, None))
     conn = None
     try:
         conn = psycopg2.connect(
@@ -65,32 +59,63 @@ async def handle_notifications():
         cursor = conn.cursor()
         cursor.execute(f"LISTEN {config('data_load_notify_channel')};")
 
-        while True:
-            await asyncio.sleep(0)  # Yield control to the event loop
-            conn.poll()
+        def read_notifications():
+            # Called by the event loop when the socket of the connection is readable,
+            # so poll() reads the pending notifications without blocking
+            try:
+                conn.poll()
+            except psycopg2.Error as e:
+                loop.remove_reader(conn)
+                notifications.put_nowait(e)
+                return
             for notify in conn.notifies:
-                try:
-                    # Process notification payload
-                    logging.info(f"Received notification: {notify.payload}")
-                    payload = json.loads(notify.payload)
-                    # Important Note: Don't use any shared connection pool inside the process
-                    # which may not be safe within multiple processes
-                    process = Process(target=load_data,
-                                      args=(payload['url'], payload['username'], payload['table_name']))
-                    process.start()
-                except Exception as e:
-                    logging.error(f"Error processing notification: {e}")
+                notifications.put_nowait(notify)
             conn.notifies.clear()
 
+        # Sleep until the connection has data instead of polling it in a loop
+        loop.add_reader(conn, read_notifications)
+
+        # Pick up the notifications received while listening
+        read_notifications()
+
+        while True:
+            # Claim jobs until all the load slots are busy or the queue is empty
+            try:
+                while scheduler.has_free_slot():
+                    job = await loop.run_in_executor(None, job_queue.claim)
+                    if job is None:
+                        break
+                    scheduler.submit(job)
+            except psycopg2.Error as e:
+                logging.error(f"Error claiming a load job: {e}")
+
+            # Sleep until a notification arrives, a load is done or the poll interval has passed
+            try:
+                notify = await asyncio.wait_for(notifications.get(), DATA_LOAD_JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+
+            while True:
+                if isinstance(notify, psycopg2.Error):
+                    raise notify
+                if notify is not None:
+                    logging.info(f"Received notification: {notify.payload}")
+                if notifications.empty():
+                    break
+                notify = notifications.get_nowait()
+
     except (psycopg2.OperationalError, psycopg2.errors.UniqueViolation) as e:
         logging.error(f"Database connection error: {e}")
         # Handle connection errors, retry logic, etc.
 
     finally:
         if conn:
+            if not conn.closed:
+                loop.remove_reader(conn)
             cursor.close()
             conn.close()
             logging.info("Database connection closed")
+        scheduler.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,268 @@
+import struct
+
+import numpy
+import shapely
+
+# The geometry types of FeatureCollectionPBuffer
+GEOMETRY_TYPE_POINT = 0
+GEOMETRY_TYPE_MULTIPOINT = 1
+GEOMETRY_TYPE_POLYLINE = 2
+GEOMETRY_TYPE_POLYGON = 3
+
+# The quantization origin of FeatureCollectionPBuffer.Transform, the y axis points down from the upper left
+QUANTIZE_ORIGIN_UPPER_LEFT = 0
+
+
+class EsriPbfError(Exception):
+    """
+        Custom exception class for errors decoding ArcGIS PBF responses.
+    """
+    pass
+
+
+def _read_varint(buffer, position):
+    """
+    Read a base 128 varint.
+
+    Returns:
+        tuple: The value and the position after it.
+    """
+    result = 0
+    shift = 0
+    while True:
+        if position >= len(buffer):
+            raise EsriPbfError("Truncated varint")
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _fields(buffer):
+    """
+    Iterate over the fields of a protobuf message.
+
+    Yields:
+        tuple: The field number and the value, which is an int for varints and a memoryview otherwise.
+    """
+    position = 0
+    end = len(buffer)
+    while position < end:
+        key, position = _read_varint(buffer, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = _read_varint(buffer, position)
+        elif wire_type == 1:
+            value, position = buffer[position:position + 8], position + 8
+        elif wire_type == 2:
+            length, position = _read_varint(buffer, position)
+            value, position = buffer[position:position + length], position + length
+        elif wire_type == 5:
+            value, position = buffer[position:position + 4], position + 4
+        else:
+            raise EsriPbfError(f"Unsupported wire type {wire_type}")
+        yield number, value
+
+
+def _zigzag(value):
+    """
+    Decode a zigzag encoded signed integer.
+    """
+    return (value >> 1) ^ -(value & 1)
+
+
+def _packed_varints(buffer):
+    """
+    Decode packed varints in a single vectorized pass.
+
+    Returns:
+        numpy.ndarray: The values as unsigned 64 bit integers.
+    """
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    if len(data) == 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+
+    # Every varint ends with a byte whose high bit is clear
+    ends = numpy.flatnonzero(data < 0x80)
+    if len(ends) == 0 or ends[-1] != len(data) - 1:
+        raise EsriPbfError("Truncated packed varints")
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    shifts = (numpy.arange(len(data)) - numpy.repeat(starts, ends - starts + 1)) * 7
+    parts = (data & 0x7f).astype(numpy.uint64) << shifts.astype(numpy.uint64)
+    return numpy.add.reduceat(parts, starts)
+
+
+def _packed_sint64(buffer):
+    """
+    Decode packed zigzag encoded varints.
+
+    Returns:
+        numpy.ndarray: The values as signed 64 bit integers.
+    """
+    values = _packed_varints(buffer)
+    return (values >> numpy.uint64(1)).astype(numpy.int64) ^ -(values & numpy.uint64(1)).astype(numpy.int64)
+
+
+def _decode_value(buffer):
+    """
+    Decode a FeatureCollectionPBuffer.Value.
+    """
+    for number, value in _fields(buffer):
+        if number == 1:
+            return bytes(value).decode('utf-8')
+        if number == 2:
+            return struct.unpack('<f', value)[0]
+        if number == 3:
+            return struct.unpack('<d', value)[0]
+        if number in (4, 8):
+            return _zigzag(value)
+        if number in (5, 6, 7):
+            # int64 values are encoded as their two's complement
+            return value - (1 << 64) if number == 6 and value >= 1 << 63 else value
+        if number == 9:
+            return bool(value)
+    return None
+
+
+def _decode_transform(buffer):
+    """
+    Decode a FeatureCollectionPBuffer.Transform.
+
+    Returns:
+        tuple: The quantization origin, the (x, y) scale and the (x, y) translation.
+    """
+    origin = QUANTIZE_ORIGIN_UPPER_LEFT
+    scale = [1.0, 1.0]
+    translate = [0.0, 0.0]
+    for number, value in _fields(buffer):
+        if number == 1:
+            origin = value
+        elif number in (2, 3):
+            target = scale if number == 2 else translate
+            for axis, component in _fields(value):
+                if axis in (1, 2):
+                    target[axis - 1] = struct.unpack('<d', component)[0]
+    return origin, scale, translate
+
+
+def _to_shape(geometry_type, lengths, coords, dimensions, transform):
+    """
+    Build the shapely geometry of a feature from its quantized coordinates.
+
+    Args:
+        geometry_type (int): The geometry type of the layer.
+        lengths (numpy.ndarray): The number of points of every part.
+        coords (numpy.ndarray): The delta encoded quantized coordinates.
+        dimensions (int): The number of values of every point.
+        transform (tuple): The quantization transform of the response.
+
+    Returns:
+        Geometry or None: The geometry, or None if it has no points.
+    """
+    if len(coords) == 0:
+        return None
+
+    # The coordinates of every point are deltas from the previous point
+    origin, scale, translate = transform
+    points = numpy.cumsum(coords.reshape(-1, dimensions)[:, :2], axis=0, dtype=numpy.float64)
+    points[:, 0] = translate[0] + points[:, 0] * scale[0]
+    if origin == QUANTIZE_ORIGIN_UPPER_LEFT:
+        points[:, 1] = translate[1] - points[:, 1] * scale[1]
+    else:
+        points[:, 1] = translate[1] + points[:, 1] * scale[1]
+
+    if geometry_type == GEOMETRY_TYPE_POINT:
+        return shapely.points(points[0])
+    if geometry_type == GEOMETRY_TYPE_MULTIPOINT:
+        return shapely.multipoints(points)
+
+    parts = numpy.split(points, numpy.cumsum(lengths)[:-1]) if len(lengths) else [points]
+    if geometry_type == GEOMETRY_TYPE_POLYLINE:
+        lines = [shapely.linestrings(part) for part in parts if len(part) >= 2]
+        if not lines:
+            return None
+        return lines[0] if len(lines) == 1 else shapely.multilinestrings(lines)
+
+    if geometry_type == GEOMETRY_TYPE_POLYGON:
+        # ArcGIS rings are clockwise for exteriors and counterclockwise for holes of the previous exterior
+        polygons = []
+        for part in parts:
+            if len(part) < 4:
+                continue
+            ring = shapely.linearrings(part)
+            if shapely.is_ccw(ring) and polygons:
+                polygons[-1][1].append(ring)
+            else:
+                polygons.append((ring, []))
+        if not polygons:
+            return None
+        shapes = [shapely.polygons(shell, holes=holes or None) for shell, holes in polygons]
+        return shapes[0] if len(shapes) == 1 else shapely.multipolygons(shapes)
+
+    raise EsriPbfError(f"Unsupported geometry type {geometry_type}")
+
+
+def decode_features(content):
+    """
+    Decode the features of an ArcGIS query response in the PBF format.
+
+    The quantized coordinates of every geometry are decoded, dequantized and split into
+    parts as numpy arrays, and turned into shapely geometries without an intermediate
+    JSON representation.
+
+    Args:
+        content (bytes): The body of the response to a query with f=pbf.
+
+    Returns:
+        tuple: The attributes of every feature as a dict and the array of their shapely geometries.
+
+    Raises:
+        EsriPbfError: If the response is not a feature result in the PBF format.
+    """
+    buffer = memoryview(content)
+    query_result = next((value for number, value in _fields(buffer) if number == 2), None)
+    feature_result = None if query_result is None else next(
+        (value for number, value in _fields(query_result) if number == 1), None)
+    if feature_result is None:
+        raise EsriPbfError("The response has no feature result")
+
+    geometry_type = GEOMETRY_TYPE_POINT
+    has_z = has_m = False
+    transform = (QUANTIZE_ORIGIN_UPPER_LEFT, [1.0, 1.0], [0.0, 0.0])
+    field_names = []
+    features = []
+    for number, value in _fields(feature_result):
+        if number == 7:
+            geometry_type = value
+        elif number == 10:
+            has_z = bool(value)
+        elif number == 11:
+            has_m = bool(value)
+        elif number == 12:
+            transform = _decode_transform(value)
+        elif number == 13:
+            field_names.append(next((bytes(name).decode('utf-8') for field, name in _fields(value) if field == 1), ''))
+        elif number == 15:
+            features.append(value)
+
+    dimensions = 2 + has_z + has_m
+    properties = []
+    shapes = numpy.full(len(features), None, dtype=object)
+    for i, feature in enumerate(features):
+        attributes = []
+        for number, value in _fields(feature):
+            if number == 1:
+                attributes.append(_decode_value(value))
+            elif number == 2:
+                lengths = numpy.zeros(0, dtype=numpy.uint64)
+                coords = numpy.zeros(0, dtype=numpy.int64)
+                for field, component in _fields(value):
+                    if field == 2:
+                        lengths = _packed_varints(component)
+                    elif field == 3:
+                        coords = _packed_sint64(component)
+                shapes[i] = _to_shape(geometry_type, lengths.astype(numpy.int64), coords, dimensions, transform)
+        properties.append(dict(zip(field_names, attributes)))
+    return properties, shapes
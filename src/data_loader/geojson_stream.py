@@ -0,0 +1,180 @@
+import codecs
+import json
+
+# The number of bytes read from a response at a time
+READ_SIZE = 1024 * 1024
+
+_decoder = json.JSONDecoder()
+
+_WHITESPACE = ' \t\n\r'
+
+# The characters which may continue a JSON number
+_NUMBER_CHARACTERS = '0123456789.eE+-'
+
+
+class GeoJSONStreamError(Exception):
+    """
+        Custom exception class for errors parsing streamed GeoJSON.
+    """
+    pass
+
+
+class _Buffer():
+    """
+    The text decoded from a stream of bytes which has not been parsed yet.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.position = 0
+        self.exhausted = False
+
+    def read_more(self):
+        """
+        Append the next chunk of the stream to the text, dropping the parsed text.
+
+        Returns:
+            bool: False if the stream is exhausted, True otherwise.
+        """
+        if self.exhausted:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            self.text = self.text[self.position:] + self.decoder.decode(b'', final=True)
+        else:
+            self.text = self.text[self.position:] + self.decoder.decode(bytes(chunk))
+        self.position = 0
+        return True
+
+    def skip_whitespace(self):
+        """
+        Skip whitespace and get the next character, or None at the end of the stream.
+        """
+        while True:
+            while self.position < len(self.text) and self.text[self.position] in _WHITESPACE:
+                self.position += 1
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self.read_more():
+                return None
+
+    def expect(self, characters):
+        """
+        Skip whitespace and consume the next character, which must be one of the given characters.
+
+        Returns:
+            str: The consumed character.
+        """
+        character = self.skip_whitespace()
+        if character is None or character not in characters:
+            raise GeoJSONStreamError(f"Expected one of {characters!r} but found {character!r}")
+        self.position += 1
+        return character
+
+    def __at_number_boundary(self, end):
+        """
+        Check if the characters after a decoded number up to the end of the text could continue it.
+        """
+        while end < len(self.text) and self.text[end] in _NUMBER_CHARACTERS:
+            end += 1
+        return end == len(self.text)
+
+    def decode_value(self):
+        """
+        Skip whitespace and decode the next JSON value, reading more of the stream while the value is incomplete.
+        """
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.position)
+                # A number may continue in the next chunk, such as 1. or 1.5e at the end of a chunk
+                if self.exhausted or not isinstance(value, (int, float)) or not self.__at_number_boundary(end):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.exhausted:
+                    raise GeoJSONStreamError(f"Invalid GeoJSON: {e}")
+            self.read_more()
+
+
+def iter_features(chunks):
+    """
+    Iterate over the features of a GeoJSON feature collection read from a stream of bytes.
+
+    Only the feature being parsed and the unparsed part of the last chunk are held in memory,
+    whatever the size of the collection. The members of the collection before "features" are
+    skipped, and the members after it are not read.
+
+    Args:
+        chunks (iterable): The chunks of bytes of the collection, such as Response.iter_content().
+
+    Yields:
+        dict: The features of the collection.
+
+    Raises:
+        GeoJSONStreamError: If the stream is not a feature collection, or is an error response.
+    """
+    buffer = _Buffer(chunks)
+    buffer.expect('{')
+    if buffer.skip_whitespace() == '}':
+        raise GeoJSONStreamError("The response has no features")
+
+    while True:
+        key = buffer.decode_value()
+        buffer.expect(':')
+        if key == 'features':
+            break
+
+        value = buffer.decode_value()
+        if key == 'error':
+            raise GeoJSONStreamError(f"The server returned an error: {value}")
+        if buffer.expect(',}') == '}':
+            raise GeoJSONStreamError("The response has no features")
+
+    buffer.expect('[')
+    if buffer.skip_whitespace() == ']':
+        return
+    while True:
+        yield buffer.decode_value()
+        if buffer.expect(',]') == ']':
+            return
+
+
+def iter_bytes(data, size=READ_SIZE):
+    """
+    Iterate over bytes in chunks, without copying them.
+
+    Args:
+        data (bytes): The bytes.
+        size (int): The size of the chunks.
+
+    Yields:
+        memoryview: The chunks of the bytes.
+    """
+    view = memoryview(data)
+    for start in range(0, len(view), size):
+        yield view[start:start + size]
+
+
+def iter_batches(items, size):
+    """
+    Group items in lists of at most size items.
+
+    Args:
+        items (iterable): The items.
+        size (int): The maximum number of items in a batch.
+
+    Yields:
+        list: The batches of items.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,154 @@
+import psycopg2
+from decouple import config
+
+# Seconds a claimed job stays leased to its worker without a heartbeat
+DATA_LOAD_JOB_LEASE = config('data_load_job_lease', default=300, cast=int)
+
+# The maximum number of times a job is claimed before it is given up
+DATA_LOAD_JOB_MAX_ATTEMPTS = config('data_load_job_max_attempts', default=3, cast=int)
+
+
+class LoadJobQueue():
+    """
+    The queue of data loads stored in the md_load_jobs table.
+
+    Jobs are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so any number of data loader
+    daemons, on any number of hosts, can consume the queue without claiming the same job
+    twice. A claimed job is leased to its worker, which renews the lease with heartbeats.
+    The job of a worker which stopped renewing it is claimed again once the lease expires.
+
+    Claiming a job clears the refresh state of its URL when the state cannot be trusted: a load
+    starting from scratch must not inherit the state of earlier data, and a refresh claimed again
+    after its worker died may have replaced some rows already, so it refreshes all the features.
+
+    It is not safe to share a connection pool with multiple processes, so every operation
+    opens and uses a new connection.
+    """
+
+    def __init__(self, worker, lease):
+        """
+        Initializes a LoadJobQueue instance.
+
+        Args:
+            worker (str): The name of this worker, saved with the jobs it claims.
+            lease (int): Seconds a claimed job stays leased without a heartbeat.
+        """
+        self.worker = worker
+        self.lease = lease
+
+    @staticmethod
+    def __connect():
+        """
+        Open a new connection to the mediator database.
+        """
+        return psycopg2.connect(host=f"{config('db_host')}", dbname=f"{config('db_name')}",
+                                user=f"{config('db_user')}", password=f"{config('db_password')}",
+                                port=f"{config('db_port')}")
+
+    def claim(self):
+        """
+        Claim the oldest job which is pending or whose lease has expired.
+
+        Returns:
+            dict or None: The job_id, url, username, table_name, job_type and attempts of the claimed job,
+                          or None if no job is available.
+        """
+        conn = self.__connect()
+        try:
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE md_load_jobs
+                           SET status = 'Running',
+                               worker = %(worker)s,
+                               attempts = attempts + 1,
+                               started_time = now(),
+                               heartbeat_time = now()
+                         WHERE job_id = (
+                            SELECT job_id
+                              FROM md_load_jobs
+                             WHERE status = 'Pending'
+                                OR (status = 'Running' AND heartbeat_time < now() - %(lease)s * interval '1 second')
+                             ORDER BY job_id
+                             LIMIT 1
+                               FOR UPDATE SKIP LOCKED
+                         )
+                        RETURNING job_id, url, requested_user, table_name, job_type, attempts;
+                    """, {'worker': self.worker, 'lease': self.lease})
+                    row = cursor.fetchone()
+
+                    if row is not None:
+                        cursor.execute("""
+                            UPDATE md_data_status
+                               SET refresh_state = NULL
+                             WHERE url = %(url)s
+                               AND CASE WHEN %(job_type)s = 'refresh' THEN %(attempts)s > 1
+                                        ELSE NOT EXISTS (SELECT 1 FROM md_load_checkpoints WHERE url = %(url)s)
+                                   END;
+                        """, {'url': row[1], 'job_type': row[4], 'attempts': row[5]})
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+
+        job_id, url, username, table_name, job_type, attempts = row
+        return {
+            'job_id': job_id,
+            'url': url,
+            'username': username,
+            'table_name': table_name,
+            'job_type': job_type,
+            'attempts': attempts
+        }
+
+    def heartbeat(self, job_ids):
+        """
+        Renew the leases of the jobs run by this worker.
+
+        A job whose lease is not renewed was claimed by another worker after its lease expired,
+        or was finished meanwhile.
+
+        Args:
+            job_ids (list): The IDs of the running jobs.
+
+        Returns:
+            set: The IDs of the jobs whose leases were renewed.
+        """
+        if not job_ids:
+            return set()
+
+        conn = self.__connect()
+        try:
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE md_load_jobs
+                           SET heartbeat_time = now()
+                         WHERE job_id = ANY(%s) AND status = 'Running' AND worker = %s
+                     RETURNING job_id;
+                    """, (job_ids, self.worker))
+                    return {row[0] for row in cursor.fetchall()}
+        finally:
+            conn.close()
+
+    def complete(self, job_id, status, notes=None):
+        """
+        Finish a job run by this worker.
+
+        Args:
+            job_id (int): The ID of the job.
+            status (str): 'Done' or 'Failed'.
+            notes (str): An optional message, such as the error of a failed job.
+        """
+        conn = self.__connect()
+        try:
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE md_load_jobs
+                           SET status = %s, notes = %s, finished_time = now()
+                         WHERE job_id = %s AND status = 'Running' AND worker = %s;
+                    """, (status, notes, job_id, self.worker))
+        finally:
+            conn.close()
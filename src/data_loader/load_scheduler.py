@@ -0,0 +1,213 @@
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from decouple import config
+
+from src.data_loader.data_loader import DataLoader, DataLoaderError, LoadCancelledError
+from src.data_loader.data_loader_factory import DataLoaderFactory
+from src.data_loader.load_job_queue import DATA_LOAD_JOB_MAX_ATTEMPTS
+
+# The maximum number of datasets loaded at the same time
+DATA_LOAD_MAX_CONCURRENT_LOADS = config('data_load_max_concurrent_loads', default=4, cast=int)
+
+
+class LoadScheduler():
+    """
+    Runs the load jobs claimed by a data loader daemon with a bounded amount of parallelism.
+
+    At most max_concurrent_loads datasets are loaded at the same time, so the daemon only
+    claims a job from the load job queue when a slot is free. The chunks of all the datasets
+    being loaded are processed by a single pool of max_processes worker processes, so a burst
+    of load requests cannot fork more processes than the pool holds. While jobs run, their
+    leases are renewed by a heartbeat thread. A job whose lease could not be renewed may have
+    been claimed by another worker, so its load is cancelled before it saves more chunks.
+    """
+
+    def __init__(self, max_concurrent_loads, max_processes, job_queue, on_load_done=None):
+        """
+        Initializes a LoadScheduler instance.
+
+        Args:
+            max_concurrent_loads (int): The maximum number of datasets loaded at the same time.
+            max_processes (int): The maximum number of processes loading chunks of data.
+            job_queue (LoadJobQueue): The queue the jobs are claimed from.
+            on_load_done (callable): An optional function called from a worker thread after each load.
+        """
+        self.max_concurrent_loads = max_concurrent_loads
+        self.max_processes = max_processes
+        self.job_queue = job_queue
+        self.on_load_done = on_load_done
+        self.__load_executor = ThreadPoolExecutor(max_workers=max_concurrent_loads, thread_name_prefix='data-load')
+        self.__chunk_executor = None
+        self.__lock = threading.Lock()
+        # The cancellation event of every running job by its job ID
+        self.__running_jobs = {}
+        self.__heartbeat_thread = None
+
+    def __get_chunk_executor(self):
+        """
+        Get the process pool shared by all the loads, replacing it if a worker died abruptly.
+
+        Returns:
+            ProcessPoolExecutor: The shared process pool.
+        """
+        with self.__lock:
+            if self.__chunk_executor is None or self.__chunk_executor._broken:
+                # Loads run in threads of this process, so the workers are not forked from it
+                self.__chunk_executor = ProcessPoolExecutor(max_workers=self.max_processes,
+                                                            mp_context=multiprocessing.get_context('forkserver'))
+            return self.__chunk_executor
+
+    def has_free_slot(self):
+        """
+        Check if another load can be started.
+
+        Returns:
+            bool: True if fewer than max_concurrent_loads loads are running, False otherwise.
+        """
+        with self.__lock:
+            return len(self.__running_jobs) < self.max_concurrent_loads
+
+    def submit(self, job):
+        """
+        Start running a claimed load job.
+
+        Args:
+            job (dict): The job claimed from the load job queue.
+
+        Returns:
+            concurrent.futures.Future: The future of the load.
+        """
+        with self.__lock:
+            self.__running_jobs[job['job_id']] = threading.Event()
+            logging.info(f"Running load job {job['job_id']} for {job['url']}: {len(self.__running_jobs)} loads running")
+
+            # Start renewing the leases on the first job
+            if self.__heartbeat_thread is None or not self.__heartbeat_thread.is_alive():
+                self.__heartbeat_thread = threading.Thread(target=self.__heartbeat, name='load-job-heartbeat',
+                                                           daemon=True)
+                self.__heartbeat_thread.start()
+        return self.__load_executor.submit(self.__run, job)
+
+    def __heartbeat(self):
+        """
+        Renew the leases of the running jobs several times per lease, and cancel the jobs whose leases were lost.
+        """
+        while True:
+            time.sleep(self.job_queue.lease / 3)
+            with self.__lock:
+                job_ids = list(self.__running_jobs)
+            try:
+                renewed = self.job_queue.heartbeat(job_ids)
+            except Exception as e:
+                logging.error(f"Failed renewing the leases of the load jobs: {e}")
+                continue
+
+            with self.__lock:
+                for job_id in job_ids:
+                    # A job finished meanwhile is not running anymore
+                    if job_id not in renewed and job_id in self.__running_jobs:
+                        logging.error(f"Lost the lease of load job {job_id}, cancelling it")
+                        self.__running_jobs[job_id].set()
+
+    def __run(self, job):
+        """
+        Run a load or refresh job and record its outcome in the load job queue.
+        """
+        url = job['url']
+        with self.__lock:
+            cancelled = self.__running_jobs[job['job_id']]
+        status, notes = 'Done', None
+        try:
+            if job['attempts'] > DATA_LOAD_JOB_MAX_ATTEMPTS:
+                # The previous workers of the job died while running it
+                status, notes = 'Failed', f"Gave up after {DATA_LOAD_JOB_MAX_ATTEMPTS} attempts."
+                logging.error(f"Gave up the {job['job_type']} of {url} after {DATA_LOAD_JOB_MAX_ATTEMPTS} attempts.")
+                if job['job_type'] != 'refresh':
+                    DataLoader.set_loading_error(url, notes)
+                return
+
+            if job['job_type'] == 'refresh':
+                self.__refresh(url, job['username'], job['table_name'], cancelled)
+            else:
+                self.__load(url, job['username'], job['table_name'], cancelled)
+        except Exception as e:
+            status, notes = 'Failed', str(e)
+        finally:
+            with self.__lock:
+                self.__running_jobs.pop(job['job_id'], None)
+            try:
+                self.job_queue.complete(job['job_id'], status, notes)
+            except Exception as e:
+                logging.error(f"Failed completing load job {job['job_id']}: {e}")
+            if self.on_load_done is not None:
+                self.on_load_done()
+
+    def __load(self, url, username, table_name, cancelled):
+        """
+        Load the data at a URL with the data loader which can process it.
+
+        Args:
+            cancelled (threading.Event): Set when the load must stop.
+
+        Raises:
+            Exception: The error of the load after the data status is set to 'Error', unless the load was
+                       cancelled, as the data may be loaded by another worker then.
+        """
+        try:
+            data_loader = DataLoaderFactory.create_loader(url, table_name, username)
+
+            # If a data loader is found, proceed with loading data
+            if data_loader:
+                data_loader.executor = self.__get_chunk_executor()
+                data_loader.max_processes = self.max_processes
+                data_loader.cancelled = cancelled
+                data_loader.load()
+            else:
+                logging.error(f"No data loader was found.: {url}")
+                DataLoader.set_loading_error(url, "No data loader was found.")
+        except LoadCancelledError:
+            logging.error(f"Cancelled loading {url}.")
+            raise
+        except Exception as e:
+            logging.error(f"Encountered an error when loading {url}: {str(e)}.")
+            # The table is dropped unless some of its chunks are saved for resuming the load
+            DataLoader.set_loading_error(url, f'Encountered an error: {str(e)}.')
+            raise
+
+    def __refresh(self, url, username, table_name, cancelled):
+        """
+        Refresh the saved data at a URL with the data loader which can process it.
+        The saved data stays queryable while it is refreshed and is kept if the refresh fails.
+
+        Args:
+            cancelled (threading.Event): Set when the refresh must stop.
+
+        Raises:
+            Exception: The error of the refresh.
+        """
+        data_loader = DataLoaderFactory.create_loader(url, table_name, username)
+        if not data_loader:
+            raise DataLoaderError(f"No data loader was found for {url}")
+
+        data_loader.executor = self.__get_chunk_executor()
+        data_loader.max_processes = self.max_processes
+        data_loader.cancelled = cancelled
+        try:
+            data_loader.refresh()
+        except Exception as e:
+            logging.error(f"Encountered an error when refreshing {url}: {str(e)}.")
+            raise
+
+    def shutdown(self):
+        """
+        Wait for the running loads to complete and stop all the workers.
+        """
+        self.__load_executor.shutdown()
+        with self.__lock:
+            if self.__chunk_executor is not None:
+                self.__chunk_executor.shutdown()
+                self.__chunk_executor = None
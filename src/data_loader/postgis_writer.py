@@ -0,0 +1,324 @@
+import io
+import json
+import logging
+import struct
+
+import numpy
+import psycopg2
+import shapely
+from decouple import config
+from psycopg2 import sql
+
+from src.data_loader.data_loader import SAVE_CHECKPOINT_SQL
+
+# The header of the binary COPY format: the signature, the flags and the length of the header extension
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+
+# The trailer of the binary COPY format
+COPY_TRAILER = struct.pack('!h', -1)
+
+# The column types of the ArcGIS field types. Other field types are saved as text.
+ESRI_FIELD_TYPES = {
+    'esriFieldTypeOID': 'BIGINT',
+    'esriFieldTypeInteger': 'BIGINT',
+    'esriFieldTypeSmallInteger': 'BIGINT',
+    'esriFieldTypeDate': 'BIGINT',
+    'esriFieldTypeDouble': 'DOUBLE PRECISION',
+    'esriFieldTypeSingle': 'DOUBLE PRECISION',
+}
+
+# The column types of the XML schema types of WFS properties. Other types are saved as text.
+XSD_TYPES = {
+    'int': 'BIGINT',
+    'integer': 'BIGINT',
+    'long': 'BIGINT',
+    'short': 'BIGINT',
+    'double': 'DOUBLE PRECISION',
+    'float': 'DOUBLE PRECISION',
+    'decimal': 'DOUBLE PRECISION',
+    'boolean': 'BOOLEAN',
+}
+
+# The column types of the OGR field types reported by fiona. Other field types are saved as text.
+OGR_FIELD_TYPES = {
+    'int': 'BIGINT',
+    'int32': 'BIGINT',
+    'int64': 'BIGINT',
+    'float': 'DOUBLE PRECISION',
+    'bool': 'BOOLEAN',
+}
+
+# The binary encoders of the column types
+BINARY_ENCODERS = {
+    'BIGINT': lambda value: struct.pack('!q', int(value)),
+    'DOUBLE PRECISION': lambda value: struct.pack('!d', float(value)),
+    'BOOLEAN': lambda value: b'\x01' if value is True or str(value).lower() in ('true', '1') else b'\x00',
+    # Nested JSON values, such as the arrays and objects of GeoJSON properties, are saved as JSON text
+    'TEXT': lambda value: (json.dumps(value) if isinstance(value, (dict, list)) else str(value)).encode('utf-8'),
+}
+
+# The number of features decoded, encoded and copied at a time, which bounds the memory used by a write
+DATA_LOAD_WRITE_BATCH_SIZE = config('data_load_write_batch_size', default=500, cast=int)
+
+# The name of the geometry column, which is the same as the one written by GeoDataFrame.to_postgis
+GEOMETRY_COLUMN = 'geometry'
+
+# The connection of this process, reused by all the writes of the process
+_connection = None
+
+
+def get_connection():
+    """
+    Get the connection of this process, opening a new one if there is none or it is closed.
+
+    It is not safe to share a connection with multiple processes, so every worker process
+    has its own connection.
+
+    Returns:
+        connection: The connection of this process.
+    """
+    global _connection
+    if _connection is None or _connection.closed:
+        _connection = psycopg2.connect(host=f"{config('db_host')}", dbname=f"{config('db_name')}",
+                                       user=f"{config('db_user')}", password=f"{config('db_password')}",
+                                       port=f"{config('db_port')}")
+    return _connection
+
+
+def arcgis_columns(schema):
+    """
+    Get the columns of the table for the fields of an ArcGIS layer.
+
+    Args:
+        schema (list): The fields of the layer.
+
+    Returns:
+        list: The (name, type) of every column except the geometry column.
+    """
+    return [(field['name'], ESRI_FIELD_TYPES.get(field['type'], 'TEXT')) for field in schema]
+
+
+def wfs_columns(properties):
+    """
+    Get the columns of the table for the properties of a WFS feature type.
+
+    Args:
+        properties (dict): The XML schema type of every property, as returned by WebFeatureService.get_schema.
+
+    Returns:
+        list: The (name, type) of every column except the geometry column.
+    """
+    return [(name, XSD_TYPES.get(str(xsd_type).split(':')[-1], 'TEXT')) for name, xsd_type in properties.items()]
+
+
+def ogr_columns(properties):
+    """
+    Get the columns of the table for the fields of a layer read by fiona.
+
+    Args:
+        properties (dict): The type of every field, such as 'int:10' or 'str:80', from the schema of the collection.
+
+    Returns:
+        list: The (name, type) of every column except the geometry column.
+    """
+    return [(name, OGR_FIELD_TYPES.get(field_type.split(':')[0], 'TEXT')) for name, field_type in properties.items()]
+
+
+def ensure_table(cursor, table_name, columns, srid):
+    """
+    Create the table unless it exists, in the transaction of the write.
+
+    The table is checked on every write, as other processes may drop it. Concurrent writers
+    create it under an advisory lock, which is only taken while the table is missing.
+
+    Args:
+        cursor (cursor): A cursor of the transaction of the write.
+        table_name (str): The name of the table.
+        columns (list): The (name, type) of every column except the geometry column.
+        srid (int): The spatial reference of the geometries.
+    """
+    cursor.execute("SELECT to_regclass(quote_ident(%s)) IS NOT NULL;", (table_name,))
+    if cursor.fetchone()[0]:
+        return
+
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (table_name,))
+    definitions = [sql.SQL("{} {}").format(sql.Identifier(name), sql.SQL(column_type))
+                   for name, column_type in columns]
+    definitions.append(sql.SQL("{} geometry(Geometry, {})").format(sql.Identifier(GEOMETRY_COLUMN),
+                                                                  sql.Literal(int(srid))))
+    cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} ({});").format(sql.Identifier(table_name),
+                                                                        sql.SQL(', ').join(definitions)))
+
+
+def geojson_to_records(features):
+    """
+    Split GeoJSON features into their properties and their geometries, which are parsed in a single
+    vectorized pass.
+
+    Args:
+        features (list): The GeoJSON features.
+
+    Returns:
+        tuple: The list of the properties and the array of the shapely geometries, None if missing or unparsable.
+    """
+    properties = [feature.get('properties') or {} for feature in features]
+    geometries = [feature.get('geometry') for feature in features]
+    shapes = numpy.full(len(features), None, dtype=object)
+    present = numpy.array([geometry is not None for geometry in geometries], dtype=bool)
+    if present.any():
+        shapes[present] = shapely.from_geojson([json.dumps(geometry) for geometry in geometries if geometry is not None],
+                                               on_invalid='ignore')
+    return properties, shapes
+
+
+def to_ewkb(shapes, srid):
+    """
+    Convert shapely geometries to EWKB in a single vectorized pass.
+
+    Args:
+        shapes (array): The shapely geometries, which may be None.
+        srid (int): The spatial reference of the geometries.
+
+    Returns:
+        list: The EWKB of the valid geometries, and None for missing or invalid geometries.
+    """
+    shapes = shapely.set_srid(numpy.asarray(shapes, dtype=object), int(srid))
+    encoded = shapely.to_wkb(shapes, include_srid=True)
+    return numpy.where(shapely.is_valid(shapes), encoded, None).tolist()
+
+
+def encode_copy_data(properties, ewkb, columns):
+    """
+    Encode records in the binary COPY format. Records without a valid geometry are dropped.
+
+    Args:
+        properties (list): The attributes of every record as a dict.
+        ewkb (list): The EWKB geometry of every record, or None.
+        columns (list): The (name, type) of every column except the geometry column.
+
+    Returns:
+        tuple: The encoded data and the number of encoded records.
+    """
+    encoders = [(name, BINARY_ENCODERS[column_type]) for name, column_type in columns]
+    field_count = struct.pack('!h', len(columns) + 1)
+    null = struct.pack('!i', -1)
+
+    buffer = io.BytesIO()
+    buffer.write(COPY_HEADER)
+    count = 0
+    for attributes, geometry in zip(properties, ewkb):
+        if geometry is None:
+            continue
+
+        buffer.write(field_count)
+        for name, encode in encoders:
+            value = attributes.get(name)
+            if value is None:
+                buffer.write(null)
+            else:
+                encoded = encode(value)
+                buffer.write(struct.pack('!i', len(encoded)))
+                buffer.write(encoded)
+        buffer.write(struct.pack('!i', len(geometry)))
+        buffer.write(geometry)
+        count += 1
+    buffer.write(COPY_TRAILER)
+    buffer.seek(0)
+    return buffer, count
+
+
+def write_features(table_name, columns, srid, features, url=None, chunk_key=None, key_column=None, keys=None):
+    """
+    Write GeoJSON features to a table, see write_records.
+
+    Args:
+        table_name (str): The name of the table, which is created if it does not exist.
+        columns (list): The (name, type) of every column except the geometry column.
+        srid (int): The spatial reference of the geometries.
+        features (list): The GeoJSON features.
+        url (str): The URL of the data, required to record a checkpoint.
+        chunk_key (str): The key of the chunk recorded in md_load_checkpoints, or None.
+        key_column (str): The name of the column identifying the features, required to delete rows.
+        keys (list): The keys of the rows to be replaced, or None.
+
+    Returns:
+        int: The number of written features.
+    """
+    return write_batches(table_name, columns, srid, [geojson_to_records(features)], url=url, chunk_key=chunk_key,
+                         key_column=key_column, keys=keys)
+
+
+def write_records(table_name, columns, srid, properties, shapes, url=None, chunk_key=None, key_column=None,
+                  keys=None):
+    """
+    Write records to a table, see write_batches.
+
+    Args:
+        table_name (str): The name of the table, which is created if it does not exist.
+        columns (list): The (name, type) of every column except the geometry column.
+        srid (int): The spatial reference of the geometries.
+        properties (list): The attributes of every record as a dict.
+        shapes (array): The shapely geometry of every record. Records with a missing or invalid geometry are dropped.
+        url (str): The URL of the data, required to record a checkpoint.
+        chunk_key (str): The key of the chunk recorded in md_load_checkpoints, or None.
+        key_column (str): The name of the column identifying the features, required to delete rows.
+        keys (list): The keys of the rows to be replaced, or None.
+
+    Returns:
+        int: The number of written records.
+    """
+    return write_batches(table_name, columns, srid, [(properties, shapes)], url=url, chunk_key=chunk_key,
+                         key_column=key_column, keys=keys)
+
+
+def write_batches(table_name, columns, srid, batches, url=None, chunk_key=None, key_column=None, keys=None):
+    """
+    Write batches of records to a table with binary COPYs on the connection of this process.
+
+    Everything is done in a single transaction: the rows whose key is in keys are deleted first,
+    every batch is copied, and the checkpoint of the chunk is recorded last. The batches are
+    consumed one at a time, so only one batch is decoded and encoded in memory at a time.
+
+    Args:
+        table_name (str): The name of the table, which is created if it does not exist.
+        columns (list): The (name, type) of every column except the geometry column.
+        srid (int): The spatial reference of the geometries.
+        batches (iterable): The attributes of the records as dicts and their shapely geometries, batch by batch.
+                            Records with a missing or invalid geometry are dropped.
+        url (str): The URL of the data, required to record a checkpoint.
+        chunk_key (str): The key of the chunk recorded in md_load_checkpoints, or None.
+        key_column (str): The name of the column identifying the features, required to delete rows.
+        keys (list): The keys of the rows to be replaced, or None.
+
+    Returns:
+        int: The number of written records.
+    """
+    global _connection
+    connection = get_connection()
+    try:
+        column_names = [sql.Identifier(name) for name, _ in columns] + [sql.Identifier(GEOMETRY_COLUMN)]
+        copy_statement = sql.SQL("COPY {} ({}) FROM STDIN (FORMAT binary);").format(
+            sql.Identifier(table_name), sql.SQL(', ').join(column_names))
+
+        count = 0
+        with connection:
+            with connection.cursor() as cursor:
+                ensure_table(cursor, table_name, columns, srid)
+                if keys:
+                    cursor.execute(sql.SQL("DELETE FROM {} WHERE {} = ANY(%s);").format(
+                        sql.Identifier(table_name), sql.Identifier(key_column)), (list(keys),))
+
+                for properties, shapes in batches:
+                    data, batch_count = encode_copy_data(properties, to_ewkb(shapes, srid), columns)
+                    cursor.copy_expert(copy_statement, data)
+                    count += batch_count
+
+                if chunk_key is not None:
+                    cursor.execute(SAVE_CHECKPOINT_SQL, {'url': url, 'chunk_key': chunk_key})
+        return count
+    except psycopg2.Error as e:
+        # Open a new connection for the next write if this one is broken
+        if connection.closed:
+            _connection = None
+        logging.info(f"Failed writing to {table_name}: {e}")
+        raise
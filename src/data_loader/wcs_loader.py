@@ -1,14 +1,251 @@
+import concurrent
 import logging
+import os
+import shutil
 import subprocess
 import tempfile
 import xml
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
 
 import requests
 from decouple import config
 from owslib.wcs import WebCoverageService
+from psycopg2 import sql
 
 from src.data_loader.data_loader import DataLoader, DataLoaderError
+from src.db.mediator_db import db
+
+DATA_LOAD_RETRIES_ON_ERROR = config('data_load_retries_on_error', cast=int)
+
+# The number of grid cells along each axis of the tiles of large coverages
+DATA_LOAD_WCS_TILE_SIZE = config('data_load_wcs_tile_size', default=2048, cast=int)
+
+# The maximum number of tiles of a coverage downloaded at the same time
+DATA_LOAD_WCS_CONCURRENT_TILES = config('data_load_wcs_concurrent_tiles', default=4, cast=int)
+
+# The maximum size in bytes of a downloaded coverage or tile kept in memory. Larger ones are spooled to disk.
+DATA_LOAD_WCS_MAX_MEMORY_BYTES = config('data_load_wcs_max_memory_bytes', default=64 * 1024 * 1024, cast=int)
+
+# Seconds a GetCoverage request may take
+WCS_REQUEST_TIMEOUT = 120
+
+# The number of bytes of a coverage read from the response at a time
+WCS_READ_SIZE = 1024 * 1024
+
+
+def get_tiles(low_limits, high_limits, tile_size):
+    """
+    Split the first two axes of a grid into tiles.
+
+    Args:
+        low_limits (list): The lowest grid index along every axis.
+        high_limits (list): The highest grid index along every axis.
+        tile_size (int): The maximum number of grid cells of a tile along each axis.
+
+    Returns:
+        list: The first and last grid index along the two axes of every tile, as ((i0, i1), (j0, j1)).
+    """
+    ranges = []
+    for axis in range(2):
+        low, high = int(low_limits[axis]), int(high_limits[axis])
+        ranges.append([(start, min(start + tile_size - 1, high)) for start in range(low, high + 1, tile_size)])
+    return [(i_range, j_range) for j_range in ranges[1] for i_range in ranges[0]]
+
+
+def get_tile_subsets(tile, axis_labels, origin, offset_vectors):
+    """
+    Get the subsets along the CRS axes which select the grid cells of a tile.
+
+    The subsets run from a quarter of a cell inside the first cell to a quarter of a cell
+    inside the last cell, so tiles sharing an edge never both include the cells along it.
+
+    Args:
+        tile (tuple): The first and last grid index along the two axes of the tile.
+        axis_labels (list): The labels of the CRS axes.
+        origin (list): The CRS coordinates of the center of the first grid cell.
+        offset_vectors (list): The CRS vectors of one grid cell along each grid axis.
+
+    Returns:
+        list: The (axis label, min, max) of every CRS axis.
+    """
+    (i0, i1), (j0, j1) = tile
+    corners = [(i, j) for i in (i0 - 0.25, i1 + 0.25) for j in (j0 - 0.25, j1 + 0.25)]
+    subsets = []
+    for axis, label in enumerate(axis_labels):
+        values = [float(origin[axis]) + i * float(offset_vectors[0][axis]) + j * float(offset_vectors[1][axis])
+                  for i, j in corners]
+        subsets.append((label, min(values), max(values)))
+    return subsets
+
+
+def get_coverage_params(version, coverage_id, output_format, subsets=None, crs=None, width=None, height=None):
+    """
+    Get the parameters of a GetCoverage request, as WebCoverageService.getCoverage would send them.
+
+    Args:
+        version (str): The version of the WCS service.
+        coverage_id (str): The ID of the coverage.
+        output_format (str): The output format.
+        subsets (list): The (axis label, min, max) of the trimmed axes, or None.
+        crs (str): The CRS of the coverage, or None.
+        width (int): The width of the coverage, or None.
+        height (int): The height of the coverage, or None.
+
+    Returns:
+        list: The parameters of the request, in which 'subset' may repeat.
+    """
+    params = [('service', 'WCS'), ('version', version), ('request', 'GetCoverage'), ('CoverageID', coverage_id),
+              ('format', output_format)]
+    for name, value in [('crs', crs), ('width', width), ('height', height)]:
+        if value:
+            params.append((name, value))
+    for label, low, high in subsets or []:
+        params.append(('subset', f"{label}({low},{high})"))
+    return params
+
+
+def roll_over(buffer):
+    """
+    Move the content of an in-memory file to an unnamed temporary file on disk.
+
+    Args:
+        buffer (file): The in-memory file, which is closed.
+
+    Returns:
+        file: The temporary file, positioned at its end.
+    """
+    spooled = tempfile.TemporaryFile()
+    try:
+        buffer.seek(0)
+        shutil.copyfileobj(buffer, spooled, WCS_READ_SIZE)
+    except BaseException:
+        spooled.close()
+        raise
+    buffer.close()
+    return spooled
+
+
+@contextmanager
+def download_coverage(url, params):
+    """
+    Download a coverage into an anonymous file, which raster2pgsql can open as /dev/fd/N.
+
+    Like a SpooledTemporaryFile, the coverage is kept in memory, in a file created with memfd_create,
+    until it exceeds DATA_LOAD_WCS_MAX_MEMORY_BYTES, and is then moved to an unnamed temporary file
+    on disk, so a large coverage never has to fit in memory. Where memfd_create is not available,
+    the file is an unnamed temporary file from the start.
+
+    Args:
+        url (str): The URL of GetCoverage requests.
+        params (list): The parameters of the request.
+
+    Yields:
+        file: The file holding the coverage.
+    """
+    in_memory = hasattr(os, 'memfd_create')
+    buffer = os.fdopen(os.memfd_create('wcs-coverage'), 'w+b') if in_memory else tempfile.TemporaryFile()
+    try:
+        with requests.get(url, params=params, stream=True, timeout=WCS_REQUEST_TIMEOUT) as response:
+            logging.info(f"URL: {response.url}")
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=WCS_READ_SIZE):
+                if in_memory and buffer.tell() + len(chunk) > DATA_LOAD_WCS_MAX_MEMORY_BYTES:
+                    logging.info(f"Spooling the coverage to disk: {response.url}")
+                    buffer = roll_over(buffer)
+                    in_memory = False
+                buffer.write(chunk)
+        buffer.flush()
+        yield buffer
+    finally:
+        buffer.close()
+
+
+class CopyData():
+    """
+    Reads the rows of a COPY block of a SQL script, up to the end of data marker.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.done = False
+
+    def read(self, size=-1):
+        """
+        Read the next row, or nothing once the end of data marker is reached.
+        """
+        if self.done:
+            return b''
+        line = self.stream.readline()
+        if not line or line.rstrip(b'\r\n') == b'\\.':
+            self.done = True
+            return b''
+        return line
+
+    readline = read
+
+
+def run_sql_script(stream, cursor):
+    """
+    Run a SQL script with COPY blocks, such as the output of raster2pgsql -Y, on a cursor.
+
+    The statements of the script run in the transaction of the cursor, so its BEGIN and END are skipped.
+
+    Args:
+        stream (file): The script, read line by line.
+        cursor (cursor): The cursor.
+    """
+    for line in iter(stream.readline, b''):
+        statement = line.decode('utf-8').strip()
+        if not statement or statement.upper() in ('BEGIN;', 'END;', 'COMMIT;'):
+            continue
+        if statement.upper().startswith('COPY '):
+            cursor.copy_expert(statement, CopyData(stream))
+        else:
+            cursor.execute(statement)
+
+
+def save_tile(buffer, projection, table_name):
+    """
+    Append a GeoTIFF tile to a raster table in a single transaction.
+
+    raster2pgsql reads the tile from its anonymous file and writes COPY statements, which
+    are streamed to the database on a pooled connection as they are produced.
+
+    Args:
+        buffer (file): The file holding the GeoTIFF tile.
+        projection (str): The projection of the tile, such as 'EPSG:4326'.
+        table_name (str): The name of the raster table, which must exist.
+
+    Raises:
+        DataLoaderError: If raster2pgsql fails.
+    """
+    command = [
+        'raster2pgsql',
+        '-s',
+        projection,
+        '-a', '-F', '-Y', '-t', '100x100',
+        f'/dev/fd/{buffer.fileno()}',
+        f'public.{table_name}'
+    ]
+    # stderr goes to a file, so raster2pgsql never blocks on a full stderr pipe while stdout is read
+    with tempfile.TemporaryFile() as stderr, \
+            subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr,
+                             pass_fds=(buffer.fileno(),)) as raster2pgsql_process:
+        try:
+            with db.connection() as connection:
+                with connection.cursor() as cursor:
+                    run_sql_script(raster2pgsql_process.stdout, cursor)
+
+                    # Commit only if raster2pgsql read the whole tile
+                    if raster2pgsql_process.wait() != 0:
+                        stderr.seek(0)
+                        error = stderr.read().decode('utf-8', errors='replace')
+                        raise DataLoaderError(f'Error when saving GeoTIFF to PostGIS: {error}')
+        finally:
+            if raster2pgsql_process.poll() is None:
+                raster2pgsql_process.kill()
 
 
 class WCSLoader(DataLoader):
@@ -158,45 +395,82 @@ class WCSLoader(DataLoader):
             DataLoader.set_loading_error(self.url, f"Failed loading: {base_url}: {coverage_id}")
             raise DataLoaderError(f"The GeoTIFF format is not supported for this coverage: {self.url}");
 
-        # Download Data as GeoTIFF to a temporary file
-        logging.info(f"Downloading: {self.url}")
-        get_coverage = wcs.getCoverage(identifier=[coverage_id],
-                                       bbox=bbox,
-                                       format=output_format,
-                                       crs=projection,
-                                       width=int(high_limits[0]),
-                                       height=int(high_limits[1]),
-                                       timeout=120)
-        logging.info(f"URL: {get_coverage.geturl()}")
-        with tempfile.NamedTemporaryFile(suffix=".tif", mode="wb") as temp:
-            temp.write(get_coverage.read())
-            temp.flush()  # Ensure data is written to the file
-            logging.info(f'Saved as a temp file at: {temp.name}')
-
-            command = [
-                'raster2pgsql',
-                '-s',
-                projection,
-                '-M', '-C', '-I', '-F', '-t', '100x100',
-                temp.name,
-                f'public.{self.table_name}'
-            ]
-            try:
-                logging.info(f'Saving to PostGIS: {command}')
-                with subprocess.Popen(command, stdout=subprocess.PIPE) as raster2pgsql_process:
-                    subprocess.run(["psql", "-q",
-                                    "-h", f"{config('db_host')}",
-                                    "-p", f"{config('db_port')}",
-                                    "-U", f"{config('db_user')}",
-                                    "-d", f"{config('db_name')}"],
-                                   stdin=raster2pgsql_process.stdout,
-                                   stdout=subprocess.DEVNULL)
-            except subprocess.CalledProcessError as error:
-                print("Error:", error)
-                print("Command output:", error.output)  # Access error out
-                raise DataLoaderError(f'Error when saving GeoTIFF to PostGIS: {error}')
+        # Get the URL of GetCoverage requests
+        try:
+            get_coverage_url = next(method.get('url') for method in wcs.getOperationByName('GetCoverage').methods
+                                    if method.get('type').lower() == 'get')
+        except Exception:
+            get_coverage_url = base_url
+
+        # Split large coverages into tiles of the two grid axes, downloaded and saved in parallel
+        tiles = [None]
+        origin = getattr(coverage.grid, 'origin', None)
+        if dimension == 2 and origin and len(offset_vectors) == 2:
+            tiles = get_tiles(low_limits, high_limits, DATA_LOAD_WCS_TILE_SIZE)
+            if len(tiles) == 1:
+                tiles = [None]
+        logging.info(f"Downloading {len(tiles)} tiles: {self.url}")
+
+        def download_tile(tile):
+            # Retry every tile on its own, each tile is saved in a single transaction
+            tries = 0
+            while True:
+                self.check_cancelled()
+                try:
+                    if tile is None:
+                        # Download the whole coverage at its native resolution
+                        params = get_coverage_params(wcs.version, coverage_id, output_format, crs=projection,
+                                                     width=int(high_limits[0]), height=int(high_limits[1]))
+                    else:
+                        params = get_coverage_params(wcs.version, coverage_id, output_format,
+                                                     subsets=get_tile_subsets(tile, axis_labels, origin,
+                                                                              offset_vectors))
+
+                    # The tile is saved as soon as it is downloaded, while the other tiles are downloading
+                    with download_coverage(get_coverage_url, params) as buffer:
+                        save_tile(buffer, projection, self.table_name)
+                    return tile
+                except Exception as e:
+                    tries += 1
+                    if tries >= DATA_LOAD_RETRIES_ON_ERROR:
+                        raise DataLoaderError(f"Failed loading the tile {tile}: {e}")
+                    logging.info(f"Try loading the tile {tile} again: {self.url}: {tries}: {e}")
+
+        self.__create_raster_table()
+        with ThreadPoolExecutor(max_workers=DATA_LOAD_WCS_CONCURRENT_TILES) as executor:
+            futures = [executor.submit(download_tile, tile) for tile in tiles]
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in done:
+                if future.exception():
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    raise future.exception()
+        self.__finish_raster_table()
 
         logging.info(f"Completed data loading: {self.url}")
 
         # Update the status
         DataLoader.update_data_status(self.url, 'Saved')
+
+    def __create_raster_table(self):
+        """
+        Create the raster table as raster2pgsql -c -F would, so the tiles can be appended in any order.
+        """
+        with db.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} "
+                                       "(rid SERIAL PRIMARY KEY, rast raster, filename text);").format(
+                    sql.Identifier('public', self.table_name)))
+
+    def __finish_raster_table(self):
+        """
+        Add the raster constraints and the spatial index, and analyze the table, as raster2pgsql -C -I -M would.
+        """
+        with db.connection() as connection:
+            # VACUUM cannot run in a transaction
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT AddRasterConstraints('public', %s, 'rast');", (self.table_name,))
+                cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING gist (ST_ConvexHull(rast));").format(
+                    sql.Identifier(f"{self.table_name}_st_convexhull_idx"), sql.Identifier('public', self.table_name)))
+                cursor.execute(sql.SQL("VACUUM ANALYZE {};").format(sql.Identifier('public', self.table_name)))
@@ -0,0 +1,287 @@
+import asyncio
+import concurrent
+import logging
+import threading
+import time
+
+import aiohttp
+from decouple import config
+
+from src.data_loader.adaptive_chunking import IN_FLIGHT_POLL_SECONDS
+from src.data_loader.data_loader import DataLoaderError
+
+DATA_LOAD_RETRIES_ON_ERROR = config('data_load_retries_on_error', cast=int)
+
+# Seconds a GetFeature request may take
+WFS_REQUEST_TIMEOUT = 120
+
+# Seconds an idle connection is kept alive for the next page
+WFS_KEEPALIVE_SECONDS = 60
+
+# The number of fetched pages of a load which may wait for a worker process, per worker process
+PAGES_BUFFERED_PER_PROCESS = 2
+
+# The maximum size in bytes of the fetched pages held in memory by all the loads of a data loader daemon
+DATA_LOAD_MAX_BUFFERED_BYTES = config('data_load_max_buffered_bytes', default=256 * 1024 * 1024, cast=int)
+
+
+class PageBuffer():
+    """
+    Accounts for the bytes of the fetched pages held in memory until a worker process has saved them.
+
+    The buffer is shared by all the loads of a data loader daemon, which run in different threads
+    with their own event loops. No page is requested while the buffer is full, so the buffered bytes
+    exceed max_bytes by at most the pages already in flight.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Initializes a PageBuffer instance.
+
+        Args:
+            max_bytes (int): The maximum size in bytes of the buffered pages.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.__condition = threading.Condition()
+
+    def has_room(self):
+        """
+        Check if another page may be requested.
+
+        Returns:
+            bool: True if the buffered pages are smaller than max_bytes, False otherwise.
+        """
+        with self.__condition:
+            return self.size < self.max_bytes
+
+    def wait_for_room(self, timeout):
+        """
+        Wait until a page is released by any load, or the timeout expires.
+        """
+        with self.__condition:
+            self.__condition.wait(timeout)
+
+    def add(self, size):
+        """
+        Account for a fetched page.
+        """
+        with self.__condition:
+            self.size += size
+
+    def release(self, size):
+        """
+        Release a page saved by a worker process, or dropped.
+        """
+        with self.__condition:
+            self.size -= size
+            self.__condition.notify_all()
+
+
+# The fetched pages of all the loads
+page_buffer = PageBuffer(DATA_LOAD_MAX_BUFFERED_BYTES)
+
+
+class AsyncWFSFetcher():
+    """
+    Fetches the pages of a WFS layer with asyncio and hands them to a process pool.
+
+    The capabilities of the service are parsed once by the loader, and the pages are requested
+    directly with GetFeature requests over a pool of keep-alive connections to the server. Many
+    pages are fetched at the same time, as many as the controller of the server allows, while
+    the worker processes decode and save the pages already fetched, so the network latency
+    overlaps with the parsing. The pages are fully buffered until a worker has saved them. At
+    most PAGES_BUFFERED_PER_PROCESS pages of a load per worker process are buffered, and no page
+    is requested while the pages of all the loads fill DATA_LOAD_MAX_BUFFERED_BYTES.
+    """
+
+    def __init__(self, get_feature_url, version, type_name, output_format, sort_by, controller, max_workers):
+        """
+        Initializes an AsyncWFSFetcher instance.
+
+        Args:
+            get_feature_url (str): The URL of GetFeature requests, from the capabilities of the WFS service.
+            version (str): The version of the WFS service.
+            type_name (str): The name of the feature type.
+            output_format (str): The output format of the features.
+            sort_by (str): The attribute sorting the features, or None.
+            controller (HostController): The controller of the server.
+            max_workers (int): The number of worker processes of the process pool the pages are saved by.
+        """
+        self.get_feature_url = get_feature_url
+        self.version = version
+        self.type_name = type_name
+        self.output_format = output_format
+        self.sort_by = sort_by
+        self.controller = controller
+        self.max_workers = max_workers
+
+    def page_params(self, start_index, count):
+        """
+        Get the parameters of the GetFeature request of a page.
+
+        Args:
+            start_index (int): The index of the first feature of the page.
+            count (int): The number of features of the page.
+
+        Returns:
+            dict: The parameters of the request.
+        """
+        params = {
+            'service': 'WFS',
+            'version': self.version,
+            'request': 'GetFeature',
+            'outputFormat': self.output_format,
+            'startIndex': start_index
+        }
+        if self.version.startswith('2'):
+            params.update({'typeNames': self.type_name, 'count': count})
+        else:
+            params.update({'typeName': self.type_name, 'maxFeatures': count})
+        if self.sort_by:
+            params['sortBy'] = self.sort_by
+        return params
+
+    def run(self, executor, next_chunk, serial_first=False):
+        """
+        Fetch the pages of the layer and process them with a process pool until no page remains.
+
+        Args:
+            executor (ProcessPoolExecutor): The process pool.
+            next_chunk (callable): Called with no arguments when a request slot is free. Returns the chunk key,
+                                   start index, feature count, function and arguments of the next page, or None
+                                   if no page remains. The function is called with the page and the arguments.
+            serial_first (bool): True to save the first page before the others, for example to let it create
+                                 the table. The other pages are fetched meanwhile.
+
+        Returns:
+            dict: The result of the function of every page by its chunk key.
+
+        Raises:
+            Exception: The error of the first failed page or of next_chunk, once the other pages are cancelled
+                       and the pages being saved by worker processes are done.
+        """
+        return asyncio.run(self.__run(executor, next_chunk, serial_first))
+
+    async def __run(self, executor, next_chunk, serial_first):
+        loop = asyncio.get_running_loop()
+        results = {}
+        tasks = set()
+        submitted = set()
+        buffered = asyncio.Semaphore(self.max_workers * PAGES_BUFFERED_PER_PROCESS)
+        table_ready = asyncio.Event()
+        if not serial_first:
+            table_ready.set()
+
+        connector = aiohttp.TCPConnector(limit_per_host=self.controller.max_in_flight,
+                                         keepalive_timeout=WFS_KEEPALIVE_SECONDS)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=WFS_REQUEST_TIMEOUT)) as session:
+            try:
+                while True:
+                    await buffered.acquire()
+                    while not page_buffer.has_room():
+                        # The room is released by the pages of this load or by other loads
+                        await loop.run_in_executor(None, page_buffer.wait_for_room, IN_FLIGHT_POLL_SECONDS)
+                        self.__raise_failed(tasks)
+                    while not self.controller.try_acquire():
+                        # The slots are released by the pages of this load or by other loads from the server
+                        await loop.run_in_executor(None, self.controller.wait_for_slot, IN_FLIGHT_POLL_SECONDS)
+                        self.__raise_failed(tasks)
+
+                    try:
+                        chunk = next_chunk()
+                    except BaseException:
+                        self.controller.release()
+                        buffered.release()
+                        raise
+                    if chunk is None:
+                        self.controller.release()
+                        buffered.release()
+                        break
+
+                    task = asyncio.create_task(self.__run_page(session, executor, chunk, buffered, table_ready,
+                                                               not tasks and not results, results, submitted))
+                    tasks.add(task)
+                    self.__raise_failed(tasks)
+
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Cancel the pages of this load only, the pool may be shared with other loads
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+                # A page being saved by a worker process cannot be cancelled, wait until it is committed
+                # or rolled back, so nothing of this load is written after it fails
+                if submitted:
+                    await loop.run_in_executor(None, concurrent.futures.wait, list(submitted))
+                raise
+        return results
+
+    @staticmethod
+    def __raise_failed(tasks):
+        """
+        Raise the error of the first failed page and forget the completed pages.
+        """
+        for task in [task for task in tasks if task.done()]:
+            tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    async def __run_page(self, session, executor, chunk, buffered, table_ready, first, results, submitted):
+        """
+        Fetch a page and process it with the process pool.
+        """
+        chunk_key, start_index, count, function, args = chunk
+        size = 0
+        try:
+            data = await self.__fetch(session, start_index, count)
+            size = len(data)
+            page_buffer.add(size)
+            if not first:
+                await table_ready.wait()
+            future = executor.submit(function, data, *args)
+            submitted.add(future)
+            try:
+                results[chunk_key] = await asyncio.wrap_future(future)
+            finally:
+                if future.done():
+                    submitted.discard(future)
+            table_ready.set()
+        finally:
+            page_buffer.release(size)
+            buffered.release()
+
+    async def __fetch(self, session, start_index, count):
+        """
+        Fetch a page, retrying on errors, and release the request slot with the metrics of the page.
+
+        Returns:
+            bytes: The page.
+        """
+        page = f"from {start_index} To {start_index + count}: {self.get_feature_url}: {self.type_name}"
+        tries = 0
+        released = failed = False
+        try:
+            while True:
+                start_time = time.monotonic()
+                try:
+                    params = self.page_params(start_index, count)
+                    async with session.get(self.get_feature_url, params=params) as response:
+                        response.raise_for_status()
+                        data = await response.read()
+                    self.controller.release(seconds=time.monotonic() - start_time, size=len(data), retries=tries)
+                    released = True
+                    logging.info(f"Fetched {page}")
+                    return data
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    tries += 1
+                    if tries >= DATA_LOAD_RETRIES_ON_ERROR:
+                        failed = True
+                        raise DataLoaderError(f"Failed fetching {page}: {e}")
+                    logging.info(f"Try fetching again {page}: {tries}: {e}")
+        finally:
+            # A cancelled page or an unexpected error only frees the slot
+            if not released:
+                self.controller.release(failed=failed)
@@ -1,14 +1,13 @@
-import concurrent
+import hashlib
 import json
 import logging
-import subprocess
-import tempfile
-import time
+import re
 import traceback
 from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse, parse_qs, parse_qsl, ParseResult, urlencode
 from xml.etree.ElementTree import fromstring
 
+import fiona
 import geopandas
 import pyproj
 import requests
@@ -16,11 +15,25 @@ from decouple import config
 from owslib.wfs import WebFeatureService
 from sqlalchemy import create_engine, NullPool
 
-from src.data_loader.data_loader import DataLoader, DataLoaderError
+from src.data_loader.adaptive_chunking import get_host_controller
+from src.data_loader.data_loader import DataLoader, DataLoaderError, LoadCancelledError, SAVE_CHECKPOINT_SQL
+from src.data_loader.geojson_stream import iter_batches, iter_bytes, iter_features
+from src.data_loader.postgis_writer import DATA_LOAD_WRITE_BATCH_SIZE, geojson_to_records, ogr_columns, \
+    wfs_columns, write_batches, write_features
+from src.data_loader.wfs_fetcher import AsyncWFSFetcher
 
 DATA_LOAD_FEATURES_PER_PROCESS = config('data_load_features_per_process', cast=int)
 DATA_LOAD_RETRIES_ON_ERROR = config('data_load_retries_on_error', cast=int)
 
+# The count attributes of a GML feature collection without features
+EMPTY_GML_PATTERN = re.compile(rb'(numberReturned|numberOfFeatures)="0"')
+
+# The count attributes of a GML feature collection
+GML_COUNT_PATTERN = re.compile(rb'(?:numberReturned|numberOfFeatures)="(\d+)"')
+
+# The constraint of the WFS 2.0 capabilities limiting the number of features of a GetFeature response
+COUNT_DEFAULT_CONSTRAINT = 'CountDefault'
+
 
 # This WFS loader is designed with two key objectives:
 #
@@ -32,95 +45,230 @@ DATA_LOAD_RETRIES_ON_ERROR = config('data_load_retries_on_error', cast=int)
 # processes smaller chunks of WFS data simultaneously, allowing for faster and more efficient loading of the entire
 # dataset. This concurrent strategy optimizes resource utilization and reduces the overall loading time.
 
-def save_gml_to_db(gml_binary, table_name, mode):
-    with tempfile.NamedTemporaryFile(suffix=".gml", mode="wb") as temp:
-        temp.write(gml_binary)
-        temp.flush()  # Ensure data is written to the file
-
-        command = [
-            "ogr2ogr",
-            f"-{mode}",
-            "-f", "PostgreSQL",
-            f"PG:dbname={config('db_name')} host={config('db_host')} port={config('db_port')} user={config('db_user')} password=password",
-            temp.name,
-            "-nln", table_name
-        ]
-        try:
-            result = subprocess.run(command, check=True, capture_output=True, text=True)
-            # print(result.stdout)  # Print successful output
-        except subprocess.CalledProcessError as error:
-            # print("Error:", error)
-            # print("Command output:", error.output)  # Access error out
-            raise DataLoaderError(f'Error when saving GML to PostGIS: {error}')
-
-
-# This function is used by a new spawned process to save WFS_LOAD_FEATURES_PER_PROCESS
-# features starting from start_index to PostGIS
-def process_load_features(self_url, base_url, version, type_name, epsg_code, start_index,
-                          sort_by, table_name, output_format, vendor):
+def save_gml_to_db(gml_binary, table_name, srid, columns=None, url=None, chunk_key=None):
+    """
+    Save the features of a GML document to a table, in a single transaction with the checkpoint of their chunk.
+
+    The document is read in memory by GDAL through fiona, without a temporary file or an ogr2ogr
+    process, and the features are copied batch by batch on the connection of this process.
+
+    Args:
+        gml_binary (bytes): The GML document.
+        table_name (str): The name of the table, which is created if it does not exist.
+        srid (int): The spatial reference of the features.
+        columns (list): The columns of the table, or None to use the fields found by GDAL.
+        url (str): The URL of the data, required to record a checkpoint.
+        chunk_key (str): The key of the chunk recorded in md_load_checkpoints, or None.
+
+    Returns:
+        int: The number of saved features.
+    """
+    # GDAL finds no layer in an empty feature collection
+    if EMPTY_GML_PATTERN.search(gml_binary[:4096]):
+        if chunk_key is not None:
+            DataLoader.save_checkpoint(url, chunk_key)
+        return 0
+
+    try:
+        with fiona.BytesCollection(bytes(gml_binary)) as collection:
+            if columns is None:
+                columns = ogr_columns(collection.schema['properties'])
+            features = (getattr(feature, '__geo_interface__', feature) for feature in collection)
+            batches = (geojson_to_records(batch) for batch in iter_batches(features, DATA_LOAD_WRITE_BATCH_SIZE))
+            return write_batches(table_name, columns, srid, batches, url=url, chunk_key=chunk_key)
+    except fiona.errors.FionaError as error:
+        raise DataLoaderError(f'Error when saving GML to PostGIS: {error}')
+
+
+def count_gml_features(gml_binary):
     """
-        Load features from a Web Feature Service (WFS) into a PostgresSQL/PostGIS database.
+    Count the features of a GML document, from the count attribute of the collection if it has one.
+
+    Args:
+        gml_binary (bytes): The GML document.
+
+    Returns:
+        int: The number of features.
+    """
+    match = GML_COUNT_PATTERN.search(gml_binary[:4096])
+    if match:
+        return int(match.group(1))
+    try:
+        with fiona.BytesCollection(bytes(gml_binary)) as collection:
+            return sum(1 for _ in collection)
+    except fiona.errors.FionaError as error:
+        raise DataLoaderError(f'Error when reading GML: {error}')
+
+
+def page_chunk_key(start_index, expected_count, returned_count):
+    """
+    Get the key of the checkpoint of a page, which covers only the features returned by the server.
+
+    Servers may cut a page to a limit of their own without telling. The checkpoint of a short page
+    then covers the returned features only, so the missing features are fetched by the next pass of
+    the load instead of being skipped for good.
+
+    Args:
+        start_index (int): The index of the first feature of the page.
+        expected_count (int): The number of features the page should have.
+        returned_count (int): The number of features returned by the server.
+
+    Returns:
+        str: The chunk key, or None if the page has no features.
+
+    Raises:
+        DataLoaderError: If the server returned more features than requested.
+    """
+    if returned_count > expected_count:
+        raise DataLoaderError(f"The server returned {returned_count} features instead of {expected_count} "
+                              f"from {start_index}")
+    if returned_count < expected_count:
+        logging.info(f"The server returned {returned_count} of {expected_count} features from {start_index}")
+    return f"{start_index}+{returned_count}" if returned_count else None
+
+
+def content_hash(data, output_format):
+    """
+    Hash the features of a GetFeature response, ignoring the time stamp servers add to every response.
+
+    Args:
+        data (bytes): The GetFeature response.
+        output_format (str): The output format of the response.
+
+    Returns:
+        str: The hex digest of the features.
+    """
+    if 'json' in output_format.lower():
+        features = json.loads(data)['features']
+        return hashlib.sha256(json.dumps(features, sort_keys=True).encode('utf-8')).hexdigest()
+    return hashlib.sha256(re.sub(rb'timeStamp="[^"]*"', b'', data)).hexdigest()
+
+
+class StreamingContentHash():
+    """
+    Computes the content hash of JSON features (see content_hash) while they are parsed.
+    """
+
+    def __init__(self):
+        self.digest = hashlib.sha256(b'[')
+        self.count = 0
+
+    def hash_features(self, features):
+        """
+        Hash the features as they are iterated over.
+
+        Yields:
+            dict: The features.
+        """
+        for feature in features:
+            # The same text as json.dumps of the list of all the features
+            self.digest.update(((', ' if self.count else '') + json.dumps(feature, sort_keys=True)).encode('utf-8'))
+            self.count += 1
+            yield feature
+
+    def hexdigest(self):
+        """
+        Get the hex digest of the hashed features.
+        """
+        digest = self.digest.copy()
+        digest.update(b']')
+        return digest.hexdigest()
+
+
+def parse_chunk_key(chunk_key):
+    """
+    Parse the key of a chunk of features.
+
+    Args:
+        chunk_key (str): The key of the chunk, which is its start index and its feature count joined by '+'.
+
+    Returns:
+        tuple: The start index and the feature count of the chunk.
+    """
+    start_index, count = chunk_key.split('+')
+    return int(start_index), int(count)
+
+
+# This function is used by a worker process to save a page of features fetched by the AsyncWFSFetcher to PostGIS
+def process_load_page(data, self_url, type_name, epsg_code, start_index, count, expected_count, table_name,
+                      output_format, columns=None):
+    """
+        Save a page of features from a Web Feature Service (WFS) into a PostgresSQL/PostGIS database.
 
         Args:
+            data (bytes): The GetFeature response of the page.
             self_url (str): The original URL for error logging
-            base_url (str): The base URL of the WFS service.
-            version (str): The version of the WFS service (e.g., '1.1.0', '2.0.0').
-            type_name (str): The name of the feature type to retrieve from the WFS.
+            type_name (str): The name of the feature type.
             epsg_code (str): The EPSG code representing the coordinate reference system (CRS).
-            start_index (int): The starting index for retrieving features in a paginated manner.
-            sort_by (str): The attribute to use for sorting features.
+            start_index (int): The index of the first feature of the page.
+            count (int): The number of features requested for the page.
+            expected_count (int): The number of features the page should have, which is less than count
+                                  for the last page. A page with fewer features is cut by the server,
+                                  and only its features are recorded as saved, see page_chunk_key.
             table_name (str): The name of the PostgresSQL table to store the features.
-            output_format (str): The name for the JSON output format.
-            vendor (str): The name of the server vendor.
+            output_format (str): The output format of the page.
+            columns (list): The columns of the table from the schema of the feature type, or None.
+                            With columns, JSON features are parsed and written in batches from the page,
+                            without a decoded copy of the whole page. The page itself is fully buffered,
+                            as it is fetched by the parent process.
+                            GML features are always written in batches, with the fields found by GDAL
+                            if there are no columns.
 
-        Raises:
-            DataLoaderError: If the maximum number of retries is reached and the data loading process fails.
+        Returns:
+            dict: The key of the checkpoint of the page, or None if the page has no features,
+                  the content hash of the page, see content_hash, and the number of its features.
 
-        Note:
-            This function attempts to load features from the specified WFS service into a PostgreSQL/PostGIS database.
-            It uses pagination to load features in chunks and retries in case of errors.
+        Raises:
+            DataLoaderError: If the maximum number of retries is reached and saving the page fails.
 
         Example:
-            process_load_features(
-                url='https://example.com/wfs',
-                version='2.0.0',
+            process_load_page(
+                data=response_bytes,
+                self_url='https://example.com/wfs?typename=roads',
                 type_name='roads',
                 epsg_code='4326',
                 start_index=0,
-                sort_by='objectid',
+                count=1000,
+                expected_count=1000,
                 table_name='roads_table',
                 output_format='GEOJSON',
-                vendor='ArcGIS'
+                columns=[('name', 'TEXT')]
             )
     """
-    # Set the number of retries in case of an error during loading
+    page = f"from {start_index} To {start_index + count}: {self_url}: {type_name}"
+
+    # Set the number of retries in case of an error during saving
     tries = 0
 
-    # Retry loading features in case of an error or no error
+    # Retry saving features in case of an error
     while tries < DATA_LOAD_RETRIES_ON_ERROR:
         try:
-            # Create a WebFeatureService instance
-            wfs = WebFeatureService(base_url, version, timeout=120)
-
-            # Make a GetFeature request to the WFS service
-            response = wfs.getfeature(typename=type_name,
-                                      outputFormat=output_format,
-                                      startindex=start_index,
-                                      sortby=sort_by,
-                                      maxfeatures=DATA_LOAD_FEATURES_PER_PROCESS)
-
-            data = response.read()
+            if 'json' in output_format.lower() and columns is not None:
+                # Hash and count the features, then parse and write them batch by batch, in a single transaction
+                # with their checkpoint. Only one batch is decoded at a time, the raw page is already in memory.
+                digest = StreamingContentHash()
+                for _ in digest.hash_features(iter_features(iter_bytes(data))):
+                    pass
+                chunk_key = page_chunk_key(start_index, expected_count, digest.count)
+                features = iter_features(iter_bytes(data))
+                batches = (geojson_to_records(batch) for batch in iter_batches(features, DATA_LOAD_WRITE_BATCH_SIZE))
+                write_batches(table_name, columns, int(epsg_code), batches, url=self_url, chunk_key=chunk_key)
+
+                logging.info(f"Loaded {page}")
+                return {'chunk_key': chunk_key, 'hash': digest.hexdigest(), 'count': digest.count}
+
+            data_hash = content_hash(data, output_format)
+            chunk_key, returned_count = None, 0
             if 'json' in output_format.lower():
                 # Load the JSON features from the response
                 json_features = json.loads(data)
+                returned_count = len(json_features['features'])
+                chunk_key = page_chunk_key(start_index, expected_count, returned_count)
 
                 # Sometimes the server returns an empty feature set
-                if len(json_features['features']) == 0:
-                    # Log the successful loading of features
-                    logging.info(
-                        f"Loaded from {start_index} To {start_index + DATA_LOAD_FEATURES_PER_PROCESS}: {base_url}: {type_name}")
-                    # Return after successful loading
-                    return
+                if returned_count == 0:
+                    logging.info(f"Loaded {page}")
+                    return {'chunk_key': None, 'hash': data_hash, 'count': 0}
 
                 # Create a GeoDataFrame from the JSON features with the specified CRS
                 crs = pyproj.CRS.from_epsg(int(epsg_code))
@@ -132,36 +280,72 @@ def process_load_features(self_url, base_url, version, type_name, epsg_code, sta
                 # Create the SQLAlchemy engine
                 engine = create_engine(postgres_url, poolclass=NullPool)
 
-                # Use the connection for GeoDataFrame.to_postgis
-                gdf.to_postgis(name=table_name, con=engine, schema='public', if_exists='append')
+                # Save the features and their checkpoint in a single transaction
+                with engine.begin() as connection:
+                    gdf.to_postgis(name=table_name, con=connection, schema='public', if_exists='append')
+                    connection.exec_driver_sql(SAVE_CHECKPOINT_SQL, {'url': self_url, 'chunk_key': chunk_key})
 
                 # Explicitly close the engine
                 engine.dispose()
 
             elif 'gml' in output_format.lower():
-                # gdf = geopandas.read_file(StringIO(data.decode('utf-8')), driver='GML')
-                save_gml_to_db(data, table_name, 'append')
+                returned_count = count_gml_features(data)
+                chunk_key = page_chunk_key(start_index, expected_count, returned_count)
+                save_gml_to_db(data, table_name, int(epsg_code), columns=columns, url=self_url, chunk_key=chunk_key)
 
             # Log the successful loading of features
-            logging.info(
-                f"Loaded from {start_index} To {start_index + DATA_LOAD_FEATURES_PER_PROCESS}: {base_url}: {type_name}")
+            logging.info(f"Loaded {page}")
 
-            # Return after successful loading
-            return
+            # Return the checkpoint and the content hash after successful loading
+            return {'chunk_key': chunk_key, 'hash': data_hash, 'count': returned_count}
         except Exception as e:
-            # traceback.print_exc()
             # Log the retry attempt in case of an error
-            logging.info(
-                f"Try loading again from {start_index} To {start_index + DATA_LOAD_FEATURES_PER_PROCESS}: {base_url}: {type_name}: {tries}: {e}")
+            logging.info(f"Try saving again {page}: {tries}: {e}")
             tries += 1
 
-    # If all retries fail, set the error event and raise an exception
-    DataLoader.set_loading_error(self_url,
-                                 f"Failed loading from {start_index} To {start_index + DATA_LOAD_FEATURES_PER_PROCESS}: {base_url}: {type_name}")
-    logging.info(
-        f"Failed loading from {start_index} To {start_index + DATA_LOAD_FEATURES_PER_PROCESS}: {base_url}: {type_name}")
-    raise DataLoaderError(
-        f"Failed loading from {start_index} To {start_index + DATA_LOAD_FEATURES_PER_PROCESS}: {self_url}")
+    # If all retries fail, raise an exception, the load sets the error once its other pages are done
+    logging.info(f"Failed saving {page}")
+    raise DataLoaderError(f"Failed saving {page}")
+
+
+def process_refresh_page(data, sort_by, epsg_code, table_name, output_format, saved_hash, columns, expected_count):
+    """
+        Refresh a page of features of a WFS layer in the table of its saved features.
+
+        The page is hashed. If its hash differs from the saved one, the saved rows with the sort
+        keys of the page are deleted and the features of the page are copied in batches, in a
+        single transaction.
+
+        Args:
+            data (bytes): The GetFeature response of the page.
+            sort_by (str): The attribute sorting the features, which must identify them.
+            epsg_code (str): The EPSG code of the features.
+            table_name (str): The name of the table of the saved features.
+            output_format (str): The name of a JSON output format.
+            saved_hash (str): The content hash of the page when it was saved, or None.
+            columns (list): The columns of the table from the schema of the feature type.
+            expected_count (int): The number of features the page should have.
+
+        Returns:
+            dict: The content hash of the page and the sort keys of its features.
+
+        Raises:
+            DataLoaderError: If the server cut the page, whose missing features would be deleted otherwise.
+    """
+    # Hash the page and collect its keys without keeping its features
+    digest = StreamingContentHash()
+    keys = [feature['properties'][sort_by] for feature in digest.hash_features(iter_features(iter_bytes(data)))]
+    data_hash = digest.hexdigest()
+    if len(keys) < expected_count:
+        raise DataLoaderError(f"The server returned {len(keys)} of {expected_count} features of {table_name}")
+
+    if data_hash != saved_hash:
+        features = iter_features(iter_bytes(data))
+        batches = (geojson_to_records(batch) for batch in iter_batches(features, DATA_LOAD_WRITE_BATCH_SIZE))
+        write_batches(table_name, columns, int(epsg_code), batches, key_column=sort_by, keys=keys)
+        logging.info(f"Refreshed {len(keys)} features of {table_name}")
+
+    return {'hash': data_hash, 'keys': keys}
 
 
 class WFSLoader(DataLoader):
@@ -264,10 +448,30 @@ class WFSLoader(DataLoader):
         raise DataLoaderError('Could not find the total feature number.')
 
     @staticmethod
-    def __detect_server_vendor(wfs):
+    def __get_max_features(capabilities):
+        """
+        Get the maximum number of features of a GetFeature response advertised by the server.
+
+        Args:
+            capabilities (bytes): The capabilities document.
+
+        Returns:
+            int: The CountDefault constraint of the server, or None if it is not advertised.
+        """
         try:
-            response = wfs.getcapabilities()
-            capabilities = str(response.read())
+            for element in fromstring(capabilities).iter():
+                if element.tag.endswith('}Constraint') and element.attrib.get('name') == COUNT_DEFAULT_CONSTRAINT:
+                    values = [child.text for child in element.iter()
+                              if child.tag.endswith('}DefaultValue') or child.tag.endswith('}Value')]
+                    return int(values[0]) if values else None
+        except Exception as e:
+            logging.info(f"No maximum number of features found in the capabilities: {e}")
+        return None
+
+    @staticmethod
+    def __detect_server_vendor(capabilities):
+        try:
+            capabilities = str(capabilities)
 
             # Check for GeoServer-specific namespace
             if 'geoserver' in capabilities:
@@ -287,12 +491,13 @@ class WFSLoader(DataLoader):
             print(f"Checking server vendor error: {e}")
             return 'Unknown'
 
-    def load(self):
+    def __get_service_info(self):
         """
-        Load data served by WFS into the database and update the data status.
+        Get the parameters for reading the features of the WFS layer at self.url.
 
-        This method loads data into the specified table and then updates the status
-        of the data associated with the URL to 'Saved' in the mediator's data status table.
+        Returns:
+            dict: The base_url, get_feature_url, version, typename, vendor, sort_by, output_format, total,
+                  epsg_code, columns and max_features.
         """
         # Get base url
         parsed_url = urlparse(self.url)
@@ -313,10 +518,21 @@ class WFSLoader(DataLoader):
         version = wfs.identification.version
         # logging.info(wfs.identification.__dict__)
 
+        # Get the capabilities document, which tells the server vendor and its limit of features per response
+        try:
+            capabilities = wfs.getcapabilities().read()
+        except Exception as e:
+            print(f"Reading capabilities error: {e}")
+            capabilities = b''
+
         # Get the server vendor
-        vendor = self.__detect_server_vendor(wfs)
+        vendor = self.__detect_server_vendor(capabilities)
         logging.info(f"Vendor: {vendor}")
 
+        # Pages are not larger than the limit of the server, which may cut them silently otherwise
+        max_features = self.__get_max_features(capabilities) or DATA_LOAD_FEATURES_PER_PROCESS
+        logging.info(f"Maximum features per page: {max_features}")
+
         # Get all layers
         layers = wfs.contents.keys()
         logging.info(layers)
@@ -328,14 +544,20 @@ class WFSLoader(DataLoader):
 
         # Get the schema of the typename
         sort_by = None
+        schema = None
         if vendor == 'GeoServer' or vendor == 'Unknown':
             schema = wfs.get_schema(typename)
             logging.info(f"schema: {schema['properties']}")
             sort_by = self.__get_sort_by(schema['properties'])
             logging.info(f"sort_by: {sort_by}")
 
-        # Starting index for all the features
-        start_index = 0
+        # Get the columns of the table, which let the JSON features be written in batches
+        columns = None
+        try:
+            schema = schema or wfs.get_schema(typename)
+            columns = wfs_columns(schema['properties'])
+        except Exception as e:
+            logging.info(f"No schema of {typename}, the features are not written in batches: {e}")
 
         # check the allowed output formats for GetFeature and choose json or gml if exists
         output_format = 'application/json'
@@ -361,17 +583,143 @@ class WFSLoader(DataLoader):
             output_format = 'geojson'
             logging.info(f"change the output format to {output_format} for ArcGIS")
 
+        # Get the URL of GetFeature requests, which may differ from the URL of the capabilities
+        try:
+            get_feature_url = next(method.get('url') for method in wfs.getOperationByName('GetFeature').methods
+                                   if method.get('type').lower() == 'get')
+        except Exception:
+            get_feature_url = base_url
+        logging.info(f"GetFeature URL: {get_feature_url}")
+
         # Get the total feature number
         # Note: found several cases in which the actual feature number is smaller than
         # the declared total feature number
-        total = self.__get_total_feature_count(base_url, typename, version)
+        total = self.__get_total_feature_count(get_feature_url, typename, version)
 
         # Get the projection. Sometimes returned features may not associate with an epsg code.
         epsg_code = wfs.contents[typename].crsOptions[0].code
-        crs = pyproj.CRS.from_epsg(int(epsg_code))
 
-        # create a process pool with the default number of worker processes
-        executor = ProcessPoolExecutor()
+        return {
+            'base_url': base_url,
+            'get_feature_url': get_feature_url,
+            'version': version,
+            'typename': typename,
+            'vendor': vendor,
+            'sort_by': sort_by,
+            'output_format': output_format,
+            'total': total,
+            'epsg_code': epsg_code,
+            'columns': columns,
+            'max_features': max_features
+        }
+
+
+    @staticmethod
+    def __get_refresh_chunks(saved_hashes, total, page_size):
+        """
+        Get the chunks to fetch for a refresh: the chunks saved by the load, and chunks of
+        page_size features covering the gaps between them and the features after them.
+
+        Args:
+            saved_hashes (dict): The content hashes of the saved chunks by their chunk keys.
+            total (int): The current number of features.
+            page_size (int): The number of features of the chunks covering the gaps.
+
+        Returns:
+            list: The start index and the feature count of every chunk.
+        """
+        chunks = []
+        position = 0
+        for start_index, count in sorted(parse_chunk_key(chunk_key) for chunk_key in saved_hashes):
+            if start_index < position:
+                continue
+            while position < start_index:
+                chunks.append((position, min(page_size, start_index - position)))
+                position = chunks[-1][0] + chunks[-1][1]
+            chunks.append((start_index, count))
+            position = start_index + count
+        while position < total:
+            chunks.append((position, page_size))
+            position += page_size
+        return chunks
+
+    @staticmethod
+    def __expected_count(chunk_key, total):
+        """
+        Get the number of features a page should have, which is less than its count for the last page.
+        """
+        start_index, count = parse_chunk_key(chunk_key)
+        return max(0, min(count, total - start_index))
+
+    def __get_next_chunk(self, checkpoints, total, max_features, controller, epsg_code, output_format, typename,
+                         columns):
+        """
+        Get the function returning the next page to load, which skips the chunks saved already.
+
+        Args:
+            checkpoints (list): The keys of the saved chunks.
+            total (int): The number of features of the layer.
+            max_features (int): The maximum number of features of a page.
+            controller (HostController): The controller of the server.
+
+        Returns:
+            callable: The next_chunk function of AsyncWFSFetcher.run.
+        """
+        saved_chunks = dict(parse_chunk_key(chunk_key) for chunk_key in checkpoints)
+        next_index = 0
+
+        def next_chunk():
+            nonlocal next_index
+            self.check_cancelled()
+
+            # Skip the saved chunks
+            while next_index in saved_chunks:
+                logging.info(f"Skipping saved chunk: from {next_index} to {next_index + saved_chunks[next_index]}")
+                next_index += saved_chunks[next_index]
+            if next_index >= total:
+                return None
+
+            # A chunk is not larger than the limit of the server, and ends where the next saved chunk starts
+            count = controller.chunk_size(DATA_LOAD_FEATURES_PER_PROCESS, max_size=max_features)
+            later_starts = [start for start in saved_chunks if start > next_index]
+            if later_starts:
+                count = min(count, min(later_starts) - next_index)
+
+            start_index = next_index
+            next_index += count
+            chunk_key = f"{start_index}+{count}"
+            logging.info(f"Submitting: from {start_index} to {start_index + count}: {self.url}")
+            return chunk_key, start_index, count, process_load_page, (self.url, typename, epsg_code, start_index,
+                                                                      count, self.__expected_count(chunk_key, total),
+                                                                      self.table_name, output_format, columns)
+
+        return next_chunk
+
+    def load(self):
+        """
+        Load data served by WFS into the database and update the data status.
+
+        This method loads data into the specified table and then updates the status
+        of the data associated with the URL to 'Saved' in the mediator's data status table.
+
+        Raises:
+            DataLoaderError: If a chunk fails, after the data status is set to 'Error'.
+        """
+        service_info = self.__get_service_info()
+        get_feature_url = service_info['get_feature_url']
+        version = service_info['version']
+        typename = service_info['typename']
+        sort_by = service_info['sort_by']
+        output_format = service_info['output_format']
+        total = service_info['total']
+        epsg_code = service_info['epsg_code']
+        columns = service_info['columns']
+        max_features = service_info['max_features']
+
+        # Use the process pool shared by all the loads or create one for this load
+        executor = self.executor
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=self.max_processes)
 
         # Check the pool size
         current_pool_size = executor._max_workers
@@ -380,43 +728,130 @@ class WFSLoader(DataLoader):
         available_slots = executor._max_workers - len(executor._processes)
         logging.info(f"available_slots: {available_slots}")
 
-        futures = []
-        while total > start_index:
-            available_slots = executor._max_workers - len(executor._processes)
-            logging.info(
-                f"--- Processing: from {start_index} to {start_index + DATA_LOAD_FEATURES_PER_PROCESS}: {self.url} "
-                f"available_slots: {available_slots} ---")
-
-            logging.info(f"Submitting: from {start_index} to {start_index + DATA_LOAD_FEATURES_PER_PROCESS}")
-            future = executor.submit(process_load_features, self.url,
-                                     base_url,
-                                     version,
-                                     typename,
-                                     epsg_code,
-                                     start_index,
-                                     sort_by,
-                                     self.table_name,
-                                     output_format,
-                                     vendor)
-            futures.append(future)
-
-            if start_index == 0:
-                time.sleep(5)
-
-            start_index += DATA_LOAD_FEATURES_PER_PROCESS
-
-        # Wait for all tasks to complete
-        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.ALL_COMPLETED)
-        for future in done:
-            # Process errors
-            if future.exception():
+        # Get the chunks saved by a previous load of this URL, which are not loaded again
+        checkpoints = DataLoader.get_checkpoints(self.url)
+        if checkpoints:
+            logging.info(f"Resuming the load with {len(checkpoints)} chunks saved: {self.url}")
+
+        # The chunk size and the number of chunks in flight adapt to the server
+        controller = get_host_controller(get_feature_url)
+
+        # Fetch the pages over keep-alive connections while the worker processes save the fetched ones
+        fetcher = AsyncWFSFetcher(get_feature_url, version, typename, output_format, sort_by, controller,
+                                  self.max_processes)
+        chunk_hashes = {}
+        try:
+            # Let the first page create the table
+            serial_first = not checkpoints
+            while True:
+                results = fetcher.run(executor, self.__get_next_chunk(checkpoints, total, max_features, controller,
+                                                                      epsg_code, output_format, typename, columns),
+                                      serial_first=serial_first)
+                chunk_hashes.update({result['chunk_key']: result['hash'] for result in results.values()
+                                     if result['chunk_key'] is not None})
+
+                # A page cut by the server leaves a gap, which the next pass fetches. A page without features
+                # is past the last feature, as the total declared by some servers is larger than the actual one.
+                short_pages = [chunk_key for chunk_key, result in results.items()
+                               if 0 < result['count'] < self.__expected_count(chunk_key, total)]
+                if not short_pages:
+                    break
+                logging.info(f"Fetching the features missing from {len(short_pages)} pages cut by the server: "
+                             f"{self.url}")
+                checkpoints = DataLoader.get_checkpoints(self.url)
+                serial_first = False
+        except LoadCancelledError:
+            # The data may be loaded by another worker now
+            raise
+        except Exception as e:
+            DataLoader.set_loading_error(self.url, f'Failed downloading data: {e}')
+            logging.info(f'Failed fetching data: {e}')
+            raise DataLoaderError(f'Failed downloading data: {e}') from e
+        finally:
+            if executor is not self.executor:
                 executor.shutdown()
-                concurrent.futures.wait(futures, return_when=concurrent.futures.ALL_COMPLETED)
-                DataLoader.set_loading_error(self.url, f'Failed downloading data: {future.exception()}')
-                logging.info(f'Failed fetching data: {future.exception()}')
-                return
+
+        # Save the content hashes of the chunks, so a refresh only rewrites the changed chunks
+        DataLoader.save_refresh_state(self.url, {
+            'sort_by': sort_by,
+            'chunk_hashes': chunk_hashes
+        })
 
         logging.info(f"Completed data loading: {self.url}")
 
         # Update the status
         DataLoader.update_data_status(self.url, 'Saved')
+
+    def refresh(self):
+        """
+        Refresh the saved features with the changes of the WFS layer.
+
+        WFS does not tell which features changed, so all the chunks are fetched again and
+        compared with the content hashes saved with them. Only the rows of the changed chunks
+        are replaced, and the rows whose sort keys no longer occur are deleted. This requires
+        a JSON output format, a sort attribute identifying the features and the schema of the
+        feature type.
+
+        Raises:
+            DataLoaderError: If the layer cannot be refreshed.
+        """
+        service_info = self.__get_service_info()
+        sort_by = service_info['sort_by']
+        output_format = service_info['output_format']
+        columns = service_info['columns']
+        if sort_by is None or 'json' not in output_format.lower() or columns is None:
+            raise DataLoaderError(f"Refreshing needs sorted JSON features with a schema, which are not available: "
+                                  f"{self.url}")
+
+        state = DataLoader.get_refresh_state(self.url)
+        saved_hashes = state.get('chunk_hashes', {}) if state.get('sort_by') == sort_by else {}
+
+        # Use the process pool shared by all the loads or create one for this refresh
+        executor = self.executor
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=self.max_processes)
+
+        # Fetch the chunks saved by the load, which may have different sizes, so their hashes can be compared
+        page_size = min(DATA_LOAD_FEATURES_PER_PROCESS, service_info['max_features'])
+        chunks = iter(self.__get_refresh_chunks(saved_hashes, service_info['total'], page_size))
+
+        def next_chunk():
+            self.check_cancelled()
+            chunk = next(chunks, None)
+            if chunk is None:
+                return None
+            start_index, count = chunk
+            chunk_key = f"{start_index}+{count}"
+            expected_count = max(0, min(count, service_info['total'] - start_index))
+            return chunk_key, start_index, count, process_refresh_page, (sort_by, service_info['epsg_code'],
+                                                                         self.table_name, output_format,
+                                                                         saved_hashes.get(chunk_key), columns,
+                                                                         expected_count)
+
+        fetcher = AsyncWFSFetcher(service_info['get_feature_url'], service_info['version'], service_info['typename'],
+                                  output_format, sort_by, get_host_controller(service_info['get_feature_url']),
+                                  self.max_processes)
+        try:
+            results = fetcher.run(executor, next_chunk)
+        except Exception as e:
+            raise DataLoaderError(f'Failed refreshing data: {e}')
+        finally:
+            if executor is not self.executor:
+                executor.shutdown()
+
+        # Delete the saved features which no longer occur in any chunk
+        current_keys = set()
+        for result in results.values():
+            current_keys.update(result['keys'])
+        deleted_keys = DataLoader.get_saved_keys(self.table_name, sort_by) - current_keys
+        if deleted_keys:
+            write_features(self.table_name, columns, int(service_info['epsg_code']), [], key_column=sort_by,
+                           keys=deleted_keys)
+
+        changed = sum(1 for chunk_key, result in results.items() if result['hash'] != saved_hashes.get(chunk_key))
+        logging.info(f"Refreshed {changed} of {len(results)} chunks and deleted {len(deleted_keys)} features: {self.url}")
+
+        DataLoader.save_refresh_state(self.url, {
+            'sort_by': sort_by,
+            'chunk_hashes': {chunk_key: result['hash'] for chunk_key, result in results.items()}
+        })
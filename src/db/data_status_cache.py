@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+
+import psycopg2
+from decouple import config
+
+from src.db.mediator_db import db, DATA_STATUS_NOTIFY_CHANNEL
+
+# Seconds a cached 'Saved' status is trusted without checking the database again
+DATA_STATUS_CACHE_TTL = config('data_status_cache_ttl', default=300, cast=int)
+
+# Seconds to wait before reconnecting the listener after a connection failure
+LISTEN_RETRY_INTERVAL = 10
+
+
+class DataStatusCache():
+    """
+    A process-local cache of the URLs with the status 'Saved' in the md_data_status table.
+
+    Every change of a data status is announced with a NOTIFY on the data status channel whose
+    payload is the URL. The cache listens on the channel and drops the URLs it is notified of,
+    so queries against saved data do not need a synchronous metadata query. Without a working
+    listener connection, every lookup goes to the database.
+    """
+
+    def __init__(self, database, channel, ttl):
+        """
+        Initializes an empty DataStatusCache instance.
+
+        Args:
+            database (MediatorDatabase): The database to look up uncached URLs.
+            channel (str): The channel on which data status changes are notified.
+            ttl (int): Seconds a cached 'Saved' status is trusted.
+        """
+        self.database = database
+        self.channel = channel
+        self.ttl = ttl
+        self.__saved_urls = {}
+        self.__invalidations = 0
+        self.__listener = None
+        self.__next_listen_time = 0
+        self.__lock = threading.Lock()
+
+    def __listen(self):
+        """
+        Open the connection listening on the data status channel if it is not open yet.
+        """
+        if self.__listener is not None and not self.__listener.closed:
+            return
+
+        self.__listener = psycopg2.connect(
+            host=f"{config('db_host')}",
+            dbname=f"{config('db_name')}",
+            user=f"{config('db_user')}",
+            password=f"{config('db_password')}",
+            port=f"{config('db_port')}",
+        )
+        self.__listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.__listener.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel};")
+
+        # Changes made before listening were missed, so forget everything cached before
+        self.__invalidate_all()
+
+    def __invalidate_all(self):
+        """
+        Drop all the cached statuses.
+        """
+        self.__saved_urls.clear()
+        self.__invalidations += 1
+
+    def __process_notifications(self):
+        """
+        Drop the URLs whose data status has changed since the last call.
+
+        Returns:
+            bool: True if the notifications are being received, False otherwise.
+        """
+        if time.monotonic() < self.__next_listen_time:
+            return False
+
+        try:
+            self.__listen()
+
+            # Read the pending notifications without blocking
+            self.__listener.poll()
+        except psycopg2.Error as e:
+            logging.error(f"Failed listening on {self.channel}: {e}")
+            self.__invalidate_all()
+            if self.__listener is not None:
+                self.__listener.close()
+            self.__listener = None
+            self.__next_listen_time = time.monotonic() + LISTEN_RETRY_INTERVAL
+            return False
+
+        for notify in self.__listener.notifies:
+            self.__saved_urls.pop(notify.payload, None)
+            self.__invalidations += 1
+        self.__listener.notifies.clear()
+        return True
+
+    def get_invalid_urls(self, urls):
+        """
+        Get all URLs without the status 'Saved', answering from the cache when possible.
+
+        Args:
+            urls (list): List of URLs.
+
+        Returns:
+            list: URLs without the status 'Saved'
+        """
+        if not urls:
+            return []
+
+        # Find the URLs which are not known to be saved
+        with self.__lock:
+            listening = self.__process_notifications()
+            invalidations = self.__invalidations
+            now = time.monotonic()
+            unknown_urls = [url for url in urls
+                            if not listening or url not in self.__saved_urls
+                            or now - self.__saved_urls[url] >= self.ttl]
+
+        if not unknown_urls:
+            return []
+
+        # Check the unknown URLs in the database
+        invalid_urls = self.database.get_invalid_urls(unknown_urls)
+
+        # Cache the saved URLs unless a status has changed during the lookup
+        with self.__lock:
+            if listening and invalidations == self.__invalidations:
+                for url in set(unknown_urls) - set(invalid_urls):
+                    self.__saved_urls[url] = now
+
+        return invalid_urls
+
+    def clear(self):
+        """
+        Remove all the cached statuses.
+        """
+        with self.__lock:
+            self.__invalidate_all()
+
+
+data_status_cache = DataStatusCache(db, DATA_STATUS_NOTIFY_CHANNEL, DATA_STATUS_CACHE_TTL)
@@ -0,0 +1,87 @@
+import atexit
+import logging
+import threading
+import time
+
+from decouple import config
+
+from src.db.mediator_db import db
+
+# Seconds between two updates of the last used times. Set it to 0 to update them on every query.
+LAST_USED_TIME_FLUSH_INTERVAL = config('last_used_time_flush_interval', default=10, cast=float)
+
+
+class LastUsedTimeBuffer():
+    """
+    A write-behind buffer of the last used times of URLs.
+
+    Queries only record the URLs they used. A background thread coalesces them and updates
+    the last_used_time of all the recorded URLs in a single statement once per interval, which
+    takes the update off the query path and bounds the update rate of the hottest rows.
+    """
+
+    def __init__(self, database, interval):
+        """
+        Initializes an empty LastUsedTimeBuffer instance.
+
+        Args:
+            database (MediatorDatabase): The database to update the last used times.
+            interval (float): Seconds between two updates.
+        """
+        self.database = database
+        self.interval = interval
+        self.__pending_urls = set()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def touch(self, urls):
+        """
+        Record that the URLs are used now.
+
+        Args:
+            urls (list): List of URLs.
+        """
+        if self.interval <= 0:
+            self.database.update_last_used_times(urls)
+            return
+
+        with self.__lock:
+            self.__pending_urls.update(urls)
+
+            # Start the background thread on the first use
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name='last-used-time-buffer', daemon=True)
+                self.__thread.start()
+
+    def __run(self):
+        """
+        Flush the buffer once per interval.
+        """
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Update the last used times of all the recorded URLs in a single statement.
+        """
+        with self.__lock:
+            urls = list(self.__pending_urls)
+            self.__pending_urls.clear()
+
+        if not urls:
+            return
+
+        try:
+            self.database.update_last_used_times(urls)
+        except Exception as e:
+            # Keep the URLs for the next flush
+            logging.error(f"Failed updating the last used times: {e}")
+            with self.__lock:
+                self.__pending_urls.update(urls)
+
+
+last_used_time_buffer = LastUsedTimeBuffer(db, LAST_USED_TIME_FLUSH_INTERVAL)
+
+# Do not lose the recorded URLs when the process exits
+atexit.register(last_used_time_buffer.flush)
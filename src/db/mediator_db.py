@@ -1,10 +1,194 @@
 import json
+import threading
+import time
+from contextlib import contextmanager
 
 import psycopg2
 from decouple import config
 from faker import Faker
 from psycopg2 import sql
-from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+# The channel on which data status changes are notified
+DATA_STATUS_NOTIFY_CHANNEL = config('data_status_notify_channel', default='data_status')
+
+# Seconds a thread waits for a connection when all the connections of the pool are in use
+DB_POOL_TIMEOUT = config('db_pool_timeout', default=30, cast=float)
+
+# The hot statements prepared once on every pooled connection: name -> (parameter types, statement)
+PREPARED_STATEMENTS = {
+    'md_data_exists_for_urls': ('text[]', """
+        SELECT 1 FROM md_data_status WHERE url = ANY($1) AND (status='Saved' OR status='Loading') LIMIT 1
+    """),
+    'md_claim_data_load': ('text, text, text', """
+        INSERT INTO md_data_status(url, table_name, status, fetch_requested_user)
+        VALUES ($1, $2, 'Loading', $3)
+        ON CONFLICT (url) DO UPDATE
+           SET table_name = EXCLUDED.table_name,
+               status = EXCLUDED.status,
+               fetch_requested_user = EXCLUDED.fetch_requested_user,
+               fetch_requested_time = now(),
+               status_updated_time = now(),
+               notes = NULL
+         WHERE md_data_status.status = 'Error'
+        RETURNING data_id
+    """),
+    'md_enqueue_load_job': ('text, text, text, text', """
+        INSERT INTO md_load_jobs(url, table_name, requested_user, job_type) VALUES ($1, $2, $3, $4)
+        ON CONFLICT DO NOTHING
+    """),
+    'md_update_data_status': ('text, text', """
+        UPDATE md_data_status SET status = $1, status_updated_time=now() WHERE url = $2
+    """),
+    'md_set_loading_error': ('text, text', """
+        UPDATE md_data_status SET status = 'Error', notes=$1, status_updated_time=now()
+         WHERE url = $2 AND status='Loading'
+    """),
+    'md_get_invalid_urls': ('text[]', """
+        SELECT checked_url
+        FROM unnest($1) AS checked_url
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM md_data_status
+            WHERE md_data_status.url = checked_url AND md_data_status.status = 'Saved'
+        )
+    """),
+    'md_update_last_used_times': ('text[]', """
+        UPDATE md_data_status SET last_used_time = now() WHERE url = ANY($1)
+    """),
+}
+
+
+class PreparedStatementConnection(psycopg2.extensions.connection):
+    """
+    A connection which remembers whether the hot statements are prepared on it.
+
+    Prepared statements live as long as the database session, so they are prepared once
+    when the connection is first checked out of the pool and executed by name afterwards.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements_prepared = False
+
+    def prepare_statements(self):
+        """
+        Prepare the hot statements on this connection unless they are prepared already.
+        """
+        if self.statements_prepared:
+            return
+
+        with self.cursor() as cursor:
+            # Drop the statements left by an earlier attempt which failed halfway
+            cursor.execute("DEALLOCATE ALL;")
+            for name, (parameter_types, statement) in PREPARED_STATEMENTS.items():
+                cursor.execute(f"PREPARE {name}({parameter_types}) AS {statement};")
+        self.commit()
+        self.statements_prepared = True
+
+
+class PoolMetrics():
+    """
+    Metrics of the connections checked out of a connection pool.
+
+    Attributes:
+        checkouts (int): The number of checked out connections.
+        failures (int): The number of checkouts whose transaction failed.
+        failed_checkouts (int): The number of connections which could not be checked out.
+        total_wait_time (float): Seconds spent waiting for connections from the pool.
+        max_wait_time (float): The longest wait for a connection in seconds.
+        total_checkout_time (float): Seconds the connections were checked out.
+        max_checkout_time (float): The longest checkout of a connection in seconds.
+        in_use (int): The number of connections checked out now.
+        idle (int): The number of open connections kept by the pool for the next checkouts.
+    """
+
+    def __init__(self, max_idle):
+        """
+        Initializes a PoolMetrics instance with all metrics set to 0.
+
+        Args:
+            max_idle (int): The number of returned connections the pool keeps open, the others are closed.
+        """
+        self.max_idle = max_idle
+        self.checkouts = 0
+        self.failures = 0
+        self.failed_checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_checkout_time = 0.0
+        self.max_checkout_time = 0.0
+        self.in_use = 0
+        # The pool opens max_idle connections when it is created
+        self.idle = max_idle
+        self.__lock = threading.Lock()
+
+    def __record_wait(self, wait_time):
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def checked_out(self, wait_time):
+        """
+        Record a connection checked out of the pool, reusing an idle connection if there is one.
+
+        Args:
+            wait_time (float): Seconds spent waiting for the connection.
+        """
+        with self.__lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.idle = max(0, self.idle - 1)
+            self.__record_wait(wait_time)
+
+    def checkout_failed(self, wait_time):
+        """
+        Record a connection which could not be checked out of the pool.
+
+        Args:
+            wait_time (float): Seconds spent waiting before giving up.
+        """
+        with self.__lock:
+            self.failed_checkouts += 1
+            self.__record_wait(wait_time)
+
+    def checked_in(self, checkout_time, failed, closed):
+        """
+        Record a connection returned to the pool.
+
+        Args:
+            checkout_time (float): Seconds the connection was checked out.
+            failed (bool): Whether the transaction on the connection failed.
+            closed (bool): Whether the connection was closed instead of being kept.
+        """
+        with self.__lock:
+            self.in_use -= 1
+            self.failures += 1 if failed else 0
+            self.total_checkout_time += checkout_time
+            self.max_checkout_time = max(self.max_checkout_time, checkout_time)
+            # The pool keeps at most max_idle connections and closes the others
+            if not closed and self.idle < self.max_idle:
+                self.idle += 1
+
+    def stats(self):
+        """
+        Get the metrics.
+
+        Returns:
+            dict: The metrics with the average wait and checkout times in seconds.
+        """
+        with self.__lock:
+            checkouts = max(self.checkouts, 1)
+            return {
+                'checkouts': self.checkouts,
+                'failures': self.failures,
+                'failed_checkouts': self.failed_checkouts,
+                'average_wait_time': self.total_wait_time / max(self.checkouts + self.failed_checkouts, 1),
+                'max_wait_time': self.max_wait_time,
+                'average_checkout_time': self.total_checkout_time / checkouts,
+                'max_checkout_time': self.max_checkout_time,
+                'connections_in_use': self.in_use,
+                'connections_idle': self.idle
+            }
 
 
 class MediatorDatabase():
@@ -23,22 +207,97 @@ class MediatorDatabase():
         - password: Database password.
         - port: Database port.
 
-        Connection pool is created using the ThreadedConnectionPool.
+        Connection pool is created using the ThreadedConnectionPool. A thread needing a connection
+        while all of them are in use waits up to DB_POOL_TIMEOUT seconds for one.
 
         Returns:
             None
         """
 
         # Setup a connection pool
+        max_connections = config('max_connections', cast=int)
         self.connection_pool = ThreadedConnectionPool(
             minconn=2,
-            maxconn=config('max_connections'),
+            maxconn=max_connections,
             host=config('db_host'),
             database=config('db_name'),
             user=config('db_user'),
             password=config('db_password'),
             port=config('db_port'),
+            connection_factory=PreparedStatementConnection,
         )
+        # The pool raises PoolError when it is exhausted, so the checkouts wait for a free connection here
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.metrics = PoolMetrics(max_idle=self.connection_pool.minconn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection from the pool for a single transaction.
+
+        The transaction is committed when the block succeeds and rolled back when it raises.
+        In either case the connection is reset and returned to the pool, and a broken
+        connection is closed instead of being reused. The hot statements of PREPARED_STATEMENTS
+        are prepared on the connection before it is yielded.
+
+        Yields:
+            connection: A connection from the pool.
+
+        Raises:
+            PoolError: If no connection is free within DB_POOL_TIMEOUT seconds, or the pool fails to open one.
+        """
+        start_time = time.perf_counter()
+        if not self.connection_slots.acquire(timeout=DB_POOL_TIMEOUT):
+            self.metrics.checkout_failed(time.perf_counter() - start_time)
+            raise PoolError(f"No database connection was free within {DB_POOL_TIMEOUT} seconds")
+        try:
+            connection = self.connection_pool.getconn()
+        except Exception:
+            self.connection_slots.release()
+            self.metrics.checkout_failed(time.perf_counter() - start_time)
+            raise
+        checkout_time = time.perf_counter()
+        self.metrics.checked_out(checkout_time - start_time)
+
+        failed = False
+        try:
+            connection.prepare_statements()
+            yield connection
+            connection.commit()
+        except Exception:
+            failed = True
+            try:
+                if not connection.closed:
+                    connection.rollback()
+            except psycopg2.Error:
+                # The connection is broken and will be closed
+                pass
+            raise
+        finally:
+            # Reset the connection to the default transaction behavior
+            broken = connection.closed != 0
+            if not broken:
+                try:
+                    if connection.autocommit:
+                        connection.autocommit = False
+                except psycopg2.Error:
+                    broken = True
+
+            # Return the connection to the pool, closing it if it is broken
+            try:
+                self.connection_pool.putconn(connection, close=broken)
+            finally:
+                self.connection_slots.release()
+                self.metrics.checked_in(time.perf_counter() - checkout_time, failed, broken)
+
+    def pool_metrics(self):
+        """
+        Get the metrics of the connection pool.
+
+        Returns:
+            dict: The checkout metrics and the numbers of connections in use and idle.
+        """
+        return self.metrics.stats()
 
     def data_exists_for_urls(self, urls):
         """
@@ -51,29 +310,12 @@ class MediatorDatabase():
             bool: True if data exists for any URL, False otherwise.
         """
 
-        exist = False
-
-        # Grab a connection from the pool and save data
-        with self.connection_pool.getconn() as connection:
+        # Grab a connection from the pool and check the data status
+        with self.connection() as connection:
             with connection.cursor() as cursor:
-                # Create a parameterized query with an IN clause
-                query = sql.SQL(
-                    "SELECT * FROM md_data_status WHERE url = ANY(%s) AND (status='Saved' OR status='Loading') ")
-
                 # Execute the prepared statement with the array as a parameter
-                cursor.execute(query, (urls,))
-
-                # Fetch the results
-                results = cursor.fetchall()
-
-                # Process the results
-                for row in results:
-                    exist = True
-                    break
-
-                # Commit changes and close connections
-                connection.commit()
-                self.connection_pool.putconn(connection)
+                cursor.execute("EXECUTE md_data_exists_for_urls(%s);", (urls,))
+                exist = cursor.fetchone() is not None
 
         return exist
 
@@ -91,7 +333,7 @@ class MediatorDatabase():
         """
 
         # Grab a connection from the pool and save data
-        with self.connection_pool.getconn() as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
                 # values for insertion
                 data_to_insert = {
@@ -101,18 +343,54 @@ class MediatorDatabase():
                     'fetch_requested_user': username
                 }
 
-                # Create an INSERT statement
+                # Create an INSERT statement. A URL has a single status, so a failed load is restarted
+                # by replacing its 'Error' status.
                 insert_query = """
                             INSERT INTO md_data_status(url, table_name, status, fetch_requested_user)
                             VALUES (%(url)s, %(table_name)s, %(status)s, %(fetch_requested_user)s)
+                            ON CONFLICT (url) DO UPDATE
+                               SET table_name = EXCLUDED.table_name,
+                                   status = EXCLUDED.status,
+                                   fetch_requested_user = EXCLUDED.fetch_requested_user,
+                                   fetch_requested_time = now(),
+                                   status_updated_time = now(),
+                                   notes = NULL
+                             WHERE md_data_status.status = 'Error'
                         """
 
                 # Execute the INSERT statement with the provided data
                 cursor.execute(insert_query, data_to_insert)
 
-                # Commit the transaction to persist the changes
-                connection.commit()
-                self.connection_pool.putconn(connection)
+    def claim_data_load(self, url, username, table_name, notify=True):
+        """
+        Atomically claims the loading of the data at a URL.
+
+        The 'Loading' status is saved only if the URL has no status or its previous load failed,
+        and a load job is queued for the data loader daemons in the same transaction. Of concurrent
+        claims for the same URL, only one wins.
+
+        Args:
+            url (str): The URL of the data to be loaded.
+            username (str): The username of the user requesting data.
+            table_name (str): The name of the table associated with the URL.
+            notify (bool): Whether to queue a load job for the data loader daemons.
+
+        Returns:
+            bool: True if the claim is won, False if the data is already saved or being loaded.
+        """
+
+        # Grab a connection from the pool and save data
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                # Save the 'Loading' status unless the URL is already saved or being loaded
+                cursor.execute("EXECUTE md_claim_data_load(%s, %s, %s);", (url, table_name, username))
+                claimed = cursor.fetchone() is not None
+
+                # Queue the load for the data loader daemons, which is visible only when the claim is committed
+                if claimed and notify:
+                    self.__enqueue_load_job(cursor, url, username, table_name)
+
+        return claimed
 
     def update_data_status(self, url, status):
         """
@@ -127,17 +405,13 @@ class MediatorDatabase():
         """
 
         # Grab a connection from the pool and save data
-        with self.connection_pool.getconn() as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
-                # Define UPDATE SQL statement
-                update_sql = "UPDATE md_data_status SET status = %s, status_updated_time=now() WHERE url = %s;"
+                # Execute the prepared UPDATE statement
+                cursor.execute("EXECUTE md_update_data_status(%s, %s);", (status, url))
 
-                # Execute the SQL statement
-                cursor.execute(update_sql, (status, url))
-
-                # Commit the transaction
-                connection.commit()
-                self.connection_pool.putconn(connection)
+                # Notify the status change, which is sent when the transaction is committed
+                cursor.execute("SELECT pg_notify(%s, %s);", (DATA_STATUS_NOTIFY_CHANNEL, url))
 
     def set_loading_error(self, url, error_message):
         """
@@ -152,17 +426,13 @@ class MediatorDatabase():
         """
 
         # Grab a connection from the pool and save data
-        with self.connection_pool.getconn() as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
-                # Define UPDATE SQL statement
-                update_sql = "UPDATE md_data_status SET status = 'Error', notes=%s, status_updated_time=now() WHERE url = %s AND status='Loading';"
-
-                # Execute the SQL statement
-                cursor.execute(update_sql, (error_message, url))
+                # Execute the prepared UPDATE statement
+                cursor.execute("EXECUTE md_set_loading_error(%s, %s);", (error_message, url))
 
-                # Commit the transaction
-                connection.commit()
-                self.connection_pool.putconn(connection)
+                # Notify the status change, which is sent when the transaction is committed
+                cursor.execute("SELECT pg_notify(%s, %s);", (DATA_STATUS_NOTIFY_CHANNEL, url))
 
     def get_invalid_urls(self, urls):
         """
@@ -178,35 +448,15 @@ class MediatorDatabase():
             return []
 
         # Grab a connection from the pool and save data
-        with self.connection_pool.getconn() as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
-                # Create a parameterized query with an IN clause
-                query = """
-                    SELECT checked_url
-                    FROM unnest(%s) AS checked_url
-                    WHERE NOT EXISTS (
-                        SELECT 1
-                        FROM md_data_status
-                        WHERE md_data_status.url = checked_url AND md_data_status.status = 'Saved'
-                    );
-                """
-
-                # Get the fully substituted and escaped query string
-                # substituted_query = cursor.mogrify(query, (urls,))
-
                 # Execute the prepared statement with the array as a parameter
-                cursor.execute(query, (urls,))
+                cursor.execute("EXECUTE md_get_invalid_urls(%s);", (urls,))
 
                 # Fetch all the URLs with status not 'Saved'
                 invalid_tables = [row[0] for row in cursor.fetchall()]
 
-                # Commit changes and close connections
-                connection.commit()
-                self.connection_pool.putconn(connection)
-
-                return invalid_tables
-
-        return url_tables
+        return invalid_tables
 
     def update_last_used_times(self, urls):
         """
@@ -217,37 +467,58 @@ class MediatorDatabase():
         """
 
         # Grab a connection from the pool and save data
-        with self.connection_pool.getconn() as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
-                # Create a parameterized statement for updating
-                query = """
-                    UPDATE md_data_status
-                    SET last_used_time = now()
-                    WHERE url = ANY(%s);
-                """
-
-                # Execute the statement
-                cursor.execute(query, (urls,))
-
-                # Commit changes and close connections
-                connection.commit()
-                self.connection_pool.putconn(connection)
-
-    def notify_data_load(self, url, username, table_name):
-        with self.connection_pool.getconn() as connection:
-            connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                # Execute the prepared statement
+                cursor.execute("EXECUTE md_update_last_used_times(%s);", (urls,))
+
+    def notify_data_load(self, url, username, table_name, job_type='load'):
+        """
+        Queue a load job for the data at a URL and notify the data loader daemons.
+
+        Args:
+            url (str): The URL of the data to be loaded.
+            username (str): The username of the user requesting data.
+            table_name (str): The name of the table associated with the URL.
+            job_type (str): 'load' to load the data or 'refresh' to refresh the saved data.
+
+        Returns:
+            bool: True if the job is queued, False if the URL already has an unfinished job.
+        """
+        with self.connection() as connection:
             with connection.cursor() as cursor:
-                message = {
-                    'url': url,
-                    'username': username,
-                    'table_name': table_name
-                }
-                cursor.execute(f"NOTIFY {config('data_load_notify_channel')}, "
-                               f"'{json.dumps(message)}';")
+                return self.__enqueue_load_job(cursor, url, username, table_name, job_type)
 
-                # Commit changes and close connections
-                connection.commit()
-                self.connection_pool.putconn(connection)
+    @staticmethod
+    def __enqueue_load_job(cursor, url, username, table_name, job_type='load'):
+        """
+        Queue a load job unless the URL has an unfinished one, and wake up the data loader daemons.
+
+        The job and the notification become visible when the transaction of the cursor is committed.
+        A daemon which misses the notification still finds the job in the md_load_jobs table.
+
+        Args:
+            cursor (cursor): A cursor of the transaction.
+            url (str): The URL of the data to be loaded.
+            username (str): The username of the user requesting data.
+            table_name (str): The name of the table associated with the URL.
+            job_type (str): 'load' to load the data or 'refresh' to refresh the saved data.
+
+        Returns:
+            bool: True if the job is queued, False if the URL already has an unfinished job.
+        """
+        cursor.execute("EXECUTE md_enqueue_load_job(%s, %s, %s, %s);", (url, table_name, username, job_type))
+        if cursor.rowcount != 1:
+            return False
+
+        message = {
+            'url': url,
+            'username': username,
+            'table_name': table_name,
+            'job_type': job_type
+        }
+        cursor.execute("SELECT pg_notify(%s, %s);", (config('data_load_notify_channel'), json.dumps(message)))
+        return True
 
     def save_fake_data(self, table_name):
         """
@@ -261,7 +532,7 @@ class MediatorDatabase():
         """
 
         # Grab a connection from the pool and save data
-        with self.connection_pool.getconn() as connection:
+        with self.connection() as connection:
             with connection.cursor() as cursor:
                 # create table statement
                 create_sql = f'''
@@ -293,9 +564,5 @@ class MediatorDatabase():
                 # Execute the bulk INSERT with the prepared statement
                 cursor.executemany(insert_query, data)
 
-                # Commit changes and close connections
-                connection.commit()
-                self.connection_pool.putconn(connection)
-
 
 db = MediatorDatabase()
@@ -48,21 +48,36 @@ class FetchDataStatement():
         return None
 
     def notify(self, username):
+        """
+        Queues a load job for the data loader daemons if the data for the URL doesn't already exist in the database.
+
+        Args:
+            username (str): The username associated with the data loading.
+
+        Returns:
+            bool: True if this request started loading the data, False otherwise.
+
+        Raises:
+            DataLoaderError: If no data loader is found for the URL.
+        """
+
         # Check if data for the URL already exists in the database
         if not db.data_exists_for_urls([self.url]):
             # Create a data loader from the url
-            data_loader = DataLoaderFactory.create_loader(self.url, to_table_name(self.url), username)
+            table_name = to_table_name(self.url)
+            data_loader = DataLoaderFactory.create_loader(self.url, table_name, username)
 
             # If a data loader is found, proceed with loading data
             if data_loader:
-                # Save 'Loading' status into the md_data_status table
-                db.create_new_data_status(self.url, username, to_table_name(self.url))
-
-                db.notify_data_load(self.url, username, to_table_name(self.url))
+                # Save 'Loading' status into the md_data_status table and queue a load job in md_load_jobs
+                # atomically, so only one of concurrent requests for the URL loads the data
+                return db.claim_data_load(self.url, username, table_name)
             else:
                 # Raise an error if no data loader is found for the URL
                 raise DataLoaderError(f"No data loader was found for {self.url}")
 
+        return False
+
     def fetch_data(self, username):
         """
         Fetches data for the URL if it doesn't already exist in the database.
@@ -77,15 +92,15 @@ class FetchDataStatement():
         # Check if data for the URL already exists in the database
         if not db.data_exists_for_urls([self.url]):
             # Start a new process to load data
-            data_loader = DataLoaderFactory.create_loader(self.url, to_table_name(self.url), username)
+            table_name = to_table_name(self.url)
+            data_loader = DataLoaderFactory.create_loader(self.url, table_name, username)
 
             # If a data loader is found, proceed with loading data
             if data_loader:
-                # Save 'Loading' status into the md_data_status table
-                db.create_new_data_status(self.url, username, to_table_name(self.url))
-
-                # Load data in *** ANOTHER PROCESS/THREAD *** for non-blocking
-                data_loader.load()
+                # Save 'Loading' status into the md_data_status table unless another request is loading the data
+                if db.claim_data_load(self.url, username, table_name, notify=False):
+                    # Load data in *** ANOTHER PROCESS/THREAD *** for non-blocking
+                    data_loader.load()
             else:
                 # Raise an error if no data loader is found for the URL
                 raise DataLoaderError(f"No data loader was found for {self.url}")
@@ -1,9 +1,15 @@
 import re
 
 import pglast
-from pglast.stream import IndentedStream
+from decouple import config
+from pglast.stream import IndentedStream, RawStream
 
-from src.query_parser.url_replacement_visitor import URLReplacementVisitor, is_valid_url
+from src.query_parser.url_replacement_visitor import URLReplacementVisitor, is_valid_url, may_contain_url, \
+    splice_table_names
+
+# The output mode of translated SQL: 'indented' pretty-prints it, 'compact' emits its minimal form
+# and 'splice' replaces the URLs in the original query text with their table names
+QUERY_OUTPUT_MODE = config('query_output_mode', default='indented')
 
 
 class MediatorQuery():
@@ -17,22 +23,89 @@ class MediatorQuery():
          url_to_table_mapping (dict): A mapping of URLs to corresponding table names.
      """
 
-    def __init__(self, query):
+    def __init__(self, query, output_mode=None):
         """
         Initializes a MediatorQuery instance and translate a mediator query into a SQL query.
 
         Args:
             query (str): The original SQL query.
+            output_mode (str): The output mode of the translated SQL, 'indented', 'compact' or 'splice'.
+                               It defaults to the configured query_output_mode.
         """
         self.query = query
 
+        # A query without any URL is sent to the database unchanged, so skip parsing it
+        if not may_contain_url(self.query):
+            self._ast = None
+            self.sql = self.query
+            self.url_to_table_mapping = {}
+            return
+
         # Translate the query into a sql (without processing md functions)
-        self.ast = pglast.parse_sql(self.query)
+        self._ast = pglast.parse_sql(self.query)
         visitor = URLReplacementVisitor()
-        visitor(self.ast)
-        self.sql = str(IndentedStream(comma_at_eoln=True)(self.ast))
+        visitor(self._ast)
         self.url_to_table_mapping = visitor.url_to_table_mapping
 
+        output_mode = output_mode or QUERY_OUTPUT_MODE
+        if output_mode == 'splice':
+            # Splice the table names into the original text, falling back to the compact form
+            # if any URL cannot be located in the text
+            self.sql = splice_table_names(self.query, visitor.replacements, self.url_to_table_mapping)
+            if self.sql is None:
+                self.sql = self.__to_sql(self._ast, 'compact')
+        else:
+            self.sql = self.__to_sql(self._ast, output_mode)
+
+    @staticmethod
+    def __to_sql(ast, output_mode):
+        """
+        Serialize an AST into SQL.
+
+        Args:
+            ast (pglast.Node): The AST to be serialized.
+            output_mode (str): 'indented' for pretty-printed SQL or 'compact' for the minimal SQL.
+
+        Returns:
+            str: The SQL representation of the AST.
+        """
+        if output_mode == 'indented':
+            return str(IndentedStream(comma_at_eoln=True)(ast))
+        elif output_mode == 'compact':
+            return str(RawStream()(ast))
+        else:
+            raise MediatorQueryError(f'Unknown query output mode: {output_mode}')
+
+    @classmethod
+    def from_translation(cls, query, sql, url_to_table_mapping):
+        """
+        Creates a MediatorQuery from an already translated query without parsing it again.
+
+        Args:
+            query (str): The original SQL query.
+            sql (str): The translated SQL of the query.
+            url_to_table_mapping (dict): A mapping of URLs to corresponding table names.
+
+        Returns:
+            MediatorQuery: The mediator query.
+        """
+        md_query = cls.__new__(cls)
+        md_query.query = query
+        md_query._ast = None
+        md_query.sql = sql
+        md_query.url_to_table_mapping = dict(url_to_table_mapping)
+        return md_query
+
+    @property
+    def ast(self):
+        """
+        The abstract syntax tree (AST) of the translated SQL query. It is parsed on demand
+        when the query contains no URL or was created from a previous translation.
+        """
+        if self._ast is None:
+            self._ast = pglast.parse_sql(self.sql)
+        return self._ast
+
     def is_md_fetch_data_statement(self):
         """
         Checks if the query is an md_fetch_data statement.
@@ -66,3 +139,10 @@ class MediatorQuery():
             if is_valid_url(url):
                 return url
         return None
+
+
+class MediatorQueryError(Exception):
+    """
+        Custom exception class for MediatorQuery-related errors.
+    """
+    pass
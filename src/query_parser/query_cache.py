@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+
+from decouple import config
+
+from src.query_parser.mediator_query import MediatorQuery
+from src.query_parser.url_replacement_visitor import may_contain_url
+
+QUERY_CACHE_SIZE = config('query_cache_size', default=1024, cast=int)
+
+
+class QueryCache():
+    """
+    A bounded LRU cache of translated mediator queries keyed on the query text.
+
+    Dashboards tend to send the same query text again and again. Caching the translated SQL and
+    the URL to table name mapping lets repeated queries skip parsing and re-serializing the query.
+
+    Attributes:
+        max_size (int): The maximum number of cached queries. The cache is disabled if it is 0.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups which had to translate the query.
+        evictions (int): The number of least recently used queries removed from the cache.
+    """
+
+    def __init__(self, max_size):
+        """
+        Initializes an empty QueryCache instance.
+
+        Args:
+            max_size (int): The maximum number of cached queries.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, query):
+        """
+        Get the translated mediator query for the query text, translating and caching it on a miss.
+
+        Args:
+            query (str): The original SQL query.
+
+        Returns:
+            MediatorQuery: The mediator query for the query text.
+        """
+        # Queries without any URL are not parsed at all, so they are not worth a cache entry
+        if self.max_size <= 0 or not may_contain_url(query):
+            return MediatorQuery(query)
+
+        # Look up the query and mark it as the most recently used one
+        with self.__lock:
+            entry = self.__entries.get(query)
+            if entry is not None:
+                self.__entries.move_to_end(query)
+                self.hits += 1
+                return MediatorQuery.from_translation(query, *entry)
+            self.misses += 1
+
+        # Translate the query outside the lock. Parse errors are raised to the caller and not cached.
+        md_query = MediatorQuery(query)
+
+        # Save the translation and evict the least recently used queries
+        with self.__lock:
+            self.__entries[query] = (md_query.sql, dict(md_query.url_to_table_mapping))
+            self.__entries.move_to_end(query)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+        return md_query
+
+    def clear(self):
+        """
+        Remove all the cached queries and reset the counters.
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        Get the statistics of this cache.
+
+        Returns:
+            dict: The size, maximum size, hits, misses and evictions of this cache.
+        """
+        with self.__lock:
+            return {
+                'size': len(self.__entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+query_cache = QueryCache(QUERY_CACHE_SIZE)
@@ -0,0 +1,66 @@
+import re
+
+from src.data_loader.data_loader import DataLoaderError
+from src.db.mediator_db import db
+from src.query_parser.mediator_query import MediatorQuery
+from src.query_parser.url_replacement_visitor import is_valid_url, to_table_name
+
+
+class RefreshDataStatement():
+    def __init__(self, md_query: MediatorQuery):
+        if self.validate(md_query.query):
+            self.query = md_query.query
+            self.url = self.__get_url(md_query.query)
+        else:
+            raise RefreshDataStatementError('Not a mediator refresh data statement.')
+
+    @staticmethod
+    def validate(query):
+        """
+        Checks if the query is a md_refresh_data statement.
+
+        Returns:
+            bool: True if the query is a md_refresh_data statement, False otherwise.
+        """
+        return RefreshDataStatement.__get_url(query) is not None
+
+    @staticmethod
+    def __get_url(query):
+        """
+        Extracts the URL from a md_refresh_data statement.
+
+        Returns:
+            str or None: The URL if found, None otherwise.
+        """
+        pattern = r"\s*SELECT\s+md_refresh_data\s*\(\s*'([^']+)'\s*\)\s*"
+        match = re.match(pattern, query, re.IGNORECASE)
+        if match:
+            url = match.group(1)
+            if is_valid_url(url):
+                return url
+        return None
+
+    def notify(self, username):
+        """
+        Queues a refresh job for the data loader daemons if the data for the URL is saved.
+
+        Args:
+            username (str): The username associated with the refresh.
+
+        Returns:
+            bool: True if this request queued the refresh, False if the URL already has an unfinished job.
+
+        Raises:
+            DataLoaderError: If the data for the URL is not saved.
+        """
+        if db.get_invalid_urls([self.url]):
+            raise DataLoaderError(f"The data for {self.url} is not saved. Please fetch it with md_fetch_data.")
+
+        return db.notify_data_load(self.url, username, to_table_name(self.url), job_type='refresh')
+
+
+class RefreshDataStatementError(Exception):
+    """
+        Custom exception class for RefreshDataStatement-related errors.
+    """
+    pass
@@ -1,4 +1,6 @@
 import hashlib
+import re
+from functools import lru_cache
 from urllib.parse import urlparse
 
 from decouple import config
@@ -8,10 +10,21 @@ from pglast.visitors import Visitor
 # Get the secret key from the configuration
 secret_key = config('secret_key').encode()
 
+# The maximum number of URLs whose table names are memoized by to_table_name
+TABLE_NAME_CACHE_SIZE = config('table_name_cache_size', default=4096, cast=int)
 
+# A valid URL always has a scheme followed by '://'
+url_scheme_pattern = re.compile(r'[A-Za-z][A-Za-z0-9+.\-]*://')
+
+# The qualifiers which may precede a quoted URL in a qualified name, such as 'schema.' in 'schema."URL"'
+name_qualifiers_pattern = re.compile(rb'(\s*("([^"]|"")*"|[A-Za-z_][A-Za-z0-9_$]*)\s*\.)*\s*')
+
+
+@lru_cache(maxsize=TABLE_NAME_CACHE_SIZE)
 def to_table_name(input_string):
     """
     Convert an input string to a table name using MD5 hash.
+    The table names of recently used input strings are memoized, so repeated URLs are not hashed again.
 
     Args:
         input_string (str): The input string to be hashed.
@@ -53,12 +66,65 @@ def is_valid_url(url):
         return False
 
 
+def may_contain_url(query):
+    """
+    Check if a query may contain a URL with a cheap lexical scan of the query text.
+
+    Args:
+        query (str): The query to be scanned.
+
+    Returns:
+        bool: False if the query cannot contain any URL, True otherwise.
+    """
+
+    return '://' in query and url_scheme_pattern.search(query) is not None
+
+
+def splice_table_names(query, replacements, url_to_table_mapping):
+    """
+    Build the translated SQL by replacing the quoted URLs at the recorded locations of the query
+    with their table names, leaving the rest of the query text untouched.
+
+    Args:
+        query (str): The original SQL query.
+        replacements (list): A list of (location, url) tuples recorded while visiting the AST.
+        url_to_table_mapping (dict): A mapping of URLs to corresponding table names.
+
+    Returns:
+        str or None: The translated SQL, or None if a URL is not found at its recorded location.
+    """
+
+    # Node locations are byte offsets in the query
+    source = query.encode()
+
+    chunks = []
+    position = 0
+    for location, url in sorted(replacements):
+        if location is None or location < 0:
+            return None
+
+        # Find the quoted URL in the text of the node, which may start with qualifiers
+        token = b'"' + url.replace('"', '""').encode() + b'"'
+        start = source.find(token, max(location, position))
+        if start < 0 or not name_qualifiers_pattern.fullmatch(source, max(location, position), start):
+            return None
+
+        # Copy the text before the URL and replace the URL with its table name
+        chunks.append(source[position:start])
+        chunks.append(url_to_table_mapping[url].encode())
+        position = start + len(token)
+
+    chunks.append(source[position:])
+    return b''.join(chunks).decode()
+
+
 class URLReplacementVisitor(Visitor):
     """
     Visitor class for replacing URLs with hashed table names in AST.
 
     Attributes:
         url_to_table_mapping (dict): A mapping of original URLs to hashed table names.
+        replacements (list): A list of (location, url) tuples for every replaced URL in the query.
     """
 
     def __init__(self):
@@ -67,6 +133,7 @@ class URLReplacementVisitor(Visitor):
         """
         super().__init__()
         self.url_to_table_mapping = {}
+        self.replacements = []
 
     def visit(self, ancestors, node):
         """
@@ -81,10 +148,12 @@ class URLReplacementVisitor(Visitor):
             if is_valid_url(node.relname):
                 new_relname = to_table_name(node.relname)
                 self.url_to_table_mapping[node.relname] = new_relname
+                self.replacements.append((node.location, node.relname))
                 node.relname = new_relname
         elif isinstance(node, ColumnRef):
             # Replace URL with hashed table name in ColumnRef if present in mapping
             for field in node.fields:
                 if isinstance(field, String) and field.sval in self.url_to_table_mapping.keys():
+                    self.replacements.append((node.location, field.sval))
                     field.sval = self.url_to_table_mapping[field.sval]
 
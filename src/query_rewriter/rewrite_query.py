@@ -15,10 +15,12 @@ except UndefinedValueError:
 # End of Setting
 # ------------------------------------------------------------------------------
 
-from src.db.mediator_db import db
+from src.db.data_status_cache import data_status_cache
+from src.db.last_used_time_buffer import last_used_time_buffer
 from src.query_parser.fetch_data_statement import FetchDataStatement
-from src.query_parser.mediator_query import MediatorQuery
 from src.query_parser.list_data_loaders_statement import ListDataLoadersStatement
+from src.query_parser.query_cache import query_cache
+from src.query_parser.refresh_data_statement import RefreshDataStatement
 
 from src.data_loader.data_loader import DataLoaderError
 
@@ -38,8 +40,8 @@ def rewrite_query(username, query, in_transaction):
         str: The translated SQL query.
     """
 
-    # Parse the original query and translate it
-    md_query = MediatorQuery(query)
+    # Parse the original query and translate it, or reuse the translation of the same query text
+    md_query = query_cache.get(query)
     translated_sql = md_query.sql
 
     # Check if the query is "SELECT md_fetch_url(URL)" statement
@@ -60,6 +62,24 @@ def rewrite_query(username, query, in_transaction):
             traceback.print_exc()
             translated_sql = f"SELECT md_mediator_error('Encountered an error when fetching the data');"
 
+    # Check if the query is "SELECT md_refresh_data(URL)" statement
+    elif RefreshDataStatement.validate(query):
+        # Construct a RefreshDataStatement
+        refresh_data_statement = RefreshDataStatement(md_query)
+
+        try:
+            # Queue a job to refresh the saved data
+            refresh_data_statement.notify(username)
+
+            # Modify the translated SQL to query the md_v_data_status table for the specific URL
+            translated_sql = f"SELECT * FROM md_v_data_status WHERE url='{refresh_data_statement.url}'"
+        except DataLoaderError as e:
+            # Show the error message to the user
+            translated_sql = f"SELECT md_mediator_error('{str(e)}');"
+        except Exception as e:
+            traceback.print_exc()
+            translated_sql = f"SELECT md_mediator_error('Encountered an error when refreshing the data');"
+
     # Check if the query is "SELECT md_list_data_loaders()" statement
     elif ListDataLoadersStatement.validate(query):
         # Construct a ListDataLoadersStatement
@@ -76,10 +96,10 @@ def rewrite_query(username, query, in_transaction):
         urls = list(md_query.url_to_table_mapping.keys())
         if urls:
             # Get all invalid URLs
-            invalid_urls = db.get_invalid_urls(urls)
+            invalid_urls = data_status_cache.get_invalid_urls(urls)
             if not invalid_urls:
-                # All the URLs are valid. Update the last used times for URLs
-                db.update_last_used_times(urls)
+                # All the URLs are valid. Record the last used times for URLs, which are updated in the background
+                last_used_time_buffer.touch(urls)
             else:
                 # Some invalid URLs exist
                 error_message = f'The following URLs are not ready to query: {", ".join(invalid_urls)}'
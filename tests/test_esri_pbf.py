@@ -0,0 +1,143 @@
+import struct
+
+import pytest
+
+pytest.importorskip('numpy')
+shapely = pytest.importorskip('shapely')
+
+from src.data_loader.esri_pbf import GEOMETRY_TYPE_POINT, GEOMETRY_TYPE_POLYGON, GEOMETRY_TYPE_POLYLINE, \
+    EsriPbfError, decode_features
+
+# The quantization transform of the responses: real = translate + quantized * scale, with y pointing down
+SCALE = (0.5, 0.25)
+TRANSLATE = (100.0, 200.0)
+
+
+def varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field_varint(number, value):
+    return varint(number << 3) + varint(value)
+
+
+def field_double(number, value):
+    return varint(number << 3 | 1) + struct.pack('<d', value)
+
+
+def field_bytes(number, value):
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def encode_transform(origin=0, scale=SCALE, translate=TRANSLATE):
+    return (field_varint(1, origin)
+            + field_bytes(2, field_double(1, scale[0]) + field_double(2, scale[1]))
+            + field_bytes(3, field_double(1, translate[0]) + field_double(2, translate[1])))
+
+
+def encode_geometry(parts, origin=0):
+    """
+    Quantize and delta encode the parts of a geometry given in real coordinates.
+    """
+    coords = []
+    previous = (0, 0)
+    for part in parts:
+        for x, y in part:
+            qx = round((x - TRANSLATE[0]) / SCALE[0])
+            qy = round((TRANSLATE[1] - y) / SCALE[1] if origin == 0 else (y - TRANSLATE[1]) / SCALE[1])
+            coords += [qx - previous[0], qy - previous[1]]
+            previous = (qx, qy)
+    lengths = b''.join(varint(len(part)) for part in parts)
+    return field_bytes(2, lengths) + field_bytes(3, b''.join(varint(zigzag(value)) for value in coords))
+
+
+def encode_response(geometry_type, field_names, features, transform=None):
+    """
+    Encode a FeatureCollectionPBuffer with a single feature result.
+
+    Args:
+        features (list): The encoded attribute values and the encoded geometry or None of every feature.
+    """
+    feature_result = field_varint(7, geometry_type) + field_bytes(12, transform or encode_transform())
+    for name in field_names:
+        feature_result += field_bytes(13, field_bytes(1, name.encode('utf-8')))
+    for values, geometry in features:
+        feature = b''.join(field_bytes(1, value) for value in values)
+        if geometry is not None:
+            feature += field_bytes(2, geometry)
+        feature_result += field_bytes(15, feature)
+    return field_bytes(2, field_bytes(1, feature_result))
+
+
+def test_point_is_dequantized():
+    content = encode_response(GEOMETRY_TYPE_POINT, [], [([], encode_geometry([[(102.0, 198.0)]]))])
+    _, shapes = decode_features(content)
+    assert shapes[0].equals(shapely.Point(102.0, 198.0))
+
+
+def test_quantization_transform_is_applied():
+    # The quantized coordinates are (4, 8) from the upper left and (4, -8) from the lower left
+    content = encode_response(GEOMETRY_TYPE_POINT, [], [([], field_bytes(3, varint(zigzag(4)) + varint(zigzag(8))))])
+    _, shapes = decode_features(content)
+    assert (shapes[0].x, shapes[0].y) == (102.0, 198.0)
+
+    content = encode_response(GEOMETRY_TYPE_POINT, [], [([], encode_geometry([[(102.0, 198.0)]], origin=1))],
+                              transform=encode_transform(origin=1))
+    _, shapes = decode_features(content)
+    assert (shapes[0].x, shapes[0].y) == (102.0, 198.0)
+
+
+def test_polyline():
+    line = [(100.0, 200.0), (101.5, 199.25), (103.0, 201.0)]
+    content = encode_response(GEOMETRY_TYPE_POLYLINE, [], [([], encode_geometry([line]))])
+    _, shapes = decode_features(content)
+    assert shapes[0].equals(shapely.LineString(line))
+
+
+def test_polygon_with_hole():
+    # Exterior rings are clockwise, holes are counterclockwise
+    exterior = [(100.0, 190.0), (100.0, 200.0), (110.0, 200.0), (110.0, 190.0), (100.0, 190.0)]
+    hole = [(102.0, 192.0), (108.0, 192.0), (108.0, 198.0), (102.0, 198.0), (102.0, 192.0)]
+    content = encode_response(GEOMETRY_TYPE_POLYGON, [], [([], encode_geometry([exterior, hole]))])
+    _, shapes = decode_features(content)
+    assert shapes[0].geom_type == 'Polygon'
+    assert len(shapes[0].interiors) == 1
+    assert shapes[0].equals(shapely.Polygon(exterior, [hole]))
+    assert shapes[0].area == 100.0 - 36.0
+
+
+def test_null_geometry():
+    content = encode_response(GEOMETRY_TYPE_POINT, ['name'], [([field_bytes(1, b'no geometry')], None)])
+    properties, shapes = decode_features(content)
+    assert properties == [{'name': 'no geometry'}]
+    assert shapes[0] is None
+
+
+def test_attribute_value_types():
+    values = [
+        field_bytes(1, 'é "quoted"'.encode('utf-8')),
+        field_double(3, -1.5e10),
+        field_varint(8, zigzag(-12345678901234)),
+        field_varint(7, 2 ** 63 + 5),
+        field_varint(9, 1),
+    ]
+    content = encode_response(GEOMETRY_TYPE_POINT, ['string', 'double', 'sint64', 'uint64', 'bool'],
+                              [(values, encode_geometry([[(100.0, 200.0)]]))])
+    properties, _ = decode_features(content)
+    assert properties == [{'string': 'é "quoted"', 'double': -1.5e10, 'sint64': -12345678901234,
+                           'uint64': 2 ** 63 + 5, 'bool': True}]
+    assert isinstance(properties[0]['bool'], bool)
+
+
+def test_no_feature_result():
+    with pytest.raises(EsriPbfError):
+        decode_features(field_varint(1, 1))
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from src.data_loader.geojson_stream import GeoJSONStreamError, iter_batches, iter_bytes, iter_features
+
+COLLECTION = {
+    "type": "FeatureCollection",
+    "crs": {"type": "name", "properties": {"name": "EPSG:4326"}},
+    "totalFeatures": 3,
+    "features": [
+        {"type": "Feature", "id": 1, "geometry": {"type": "Point", "coordinates": [-117.25, 32.875]},
+         "properties": {"name": "é \"quoted\"", "count": 12345678901234, "ratio": 1.5e10, "flag": True, "none": None}},
+        {"type": "Feature", "id": 2, "geometry": None, "properties": {"values": [1, -2.5E-3, 0.0], "nested": {}}},
+        {"type": "Feature", "id": 3, "geometry": {"type": "Point", "coordinates": [0, -0.125]}, "properties": {}}
+    ],
+    "numberReturned": 3
+}
+
+
+def split_at(data, offset):
+    return [data[:offset], data[offset:]]
+
+
+@pytest.mark.parametrize('document', [
+    json.dumps(COLLECTION).encode('utf-8'),
+    b'{"features":[1.5e10,2]}',
+    b'{"features": [ -1.25E+3 , 10, 0.5 ] }',
+])
+def test_every_split_offset(document):
+    expected = json.loads(document)['features']
+    for offset in range(len(document) + 1):
+        assert list(iter_features(split_at(document, offset))) == expected, offset
+
+
+def test_single_byte_chunks():
+    document = json.dumps(COLLECTION).encode('utf-8')
+    assert list(iter_features(iter_bytes(document, 1))) == COLLECTION['features']
+
+
+def test_empty_features():
+    assert list(iter_features([b'{"type": "FeatureCollection", "features": []}'])) == []
+
+
+@pytest.mark.parametrize('document', [
+    b'{"error": {"code": 400, "message": "Invalid query"}}',
+    b'{"type": "FeatureCollection"}',
+    b'{"features": [{"type": "Feature"}',
+])
+def test_invalid_documents(document):
+    with pytest.raises(GeoJSONStreamError):
+        list(iter_features(iter_bytes(document, 3)))
+
+
+def test_batches():
+    assert [len(batch) for batch in iter_batches(range(7), 3)] == [3, 3, 1]